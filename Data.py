@@ -1,9 +1,16 @@
-import spacy
+import os
+import json
+import shutil
+import hashlib
+import zlib
+import re
+import numpy as np
 
 from collections import Counter
 from operator import itemgetter
 from collections import OrderedDict
 from random import choice
+from itertools import islice
 from tqdm import tqdm
 
 import torch
@@ -19,12 +26,13 @@ class TuplesListDataset(Dataset):
         super(TuplesListDataset, self).__init__()
         self.tuplelist = tuplelist
         self.mappings = {}
+        self.vectorized = {}
 
     def __len__(self):
         return len(self.tuplelist)
 
     def __getitem__(self,index):
-        if len(self.mappings) == 0:
+        if len(self.mappings) == 0 and len(self.vectorized) == 0:
             return self.tuplelist[index]
         else:
             t = list(self.tuplelist[index])
@@ -32,6 +40,9 @@ class TuplesListDataset(Dataset):
             for i,m in self.mappings.items():
                 t[i] = m[t[i]]
 
+            for i,c in self.vectorized.items():
+                t[i] = c[index]
+
             return tuple(t)
 
     def __iter__(self):
@@ -39,7 +50,10 @@ class TuplesListDataset(Dataset):
 
 
     def field_gen(self,field,transform=False):
-        if transform:
+        if not transform and field in getattr(self.tuplelist,"columns",{}):
+            for x in self.tuplelist.column(field).tolist():
+                yield x
+        elif transform:
             for i in range(len(self)):
                 yield self[i][field]
         else:
@@ -55,58 +69,160 @@ class TuplesListDataset(Dataset):
         return d,class_per
 
     def get_field_dict(self,field,offset=0):
-        d2k = {c:i for i,c in enumerate(set(self.field_gen(field)),offset)}
+        d2k = {c:i for i,c in enumerate(sorted(set(self.field_gen(field))),offset)} # sorted: same mapping in every process
         return d2k
 
-    def set_mapping(self,field,mapping=None,offset=0, unk=None):
+    def get_hashed_dict(self,field,offset=0,min_count=1,buckets=0):
+        counts = Counter(self.field_gen(field))
+        kept = sorted(k for k,c in counts.items() if c >= min_count)
+        return HashedMapping({k:i for i,k in enumerate(kept,offset)},offset+len(kept),buckets)
+
+    def set_mapping(self,field,mapping=None,offset=0, unk=None, min_count=1, buckets=0):
         """
         Sets or creates a mapping for a tuple field. Mappings are {k:v} with keys starting at offset.
+        With min_count > 1 or buckets > 0, only keys seen min_count times get their own value, see HashedMapping.
         """
         if mapping is None:
-            mapping = self.get_field_dict(field,offset)
+            if min_count > 1 or buckets > 0:
+                mapping = self.get_hashed_dict(field,offset,min_count,buckets)
+            else:
+                mapping = self.get_field_dict(field,offset)
 
         else:
-            if unk is not None:
+            if unk is not None and not isinstance(mapping,HashedMapping): # hashed mappings handle unseen keys
                 mapping.update(((uk,unk) for uk in set(self.field_gen(field)) if uk not in mapping))
             
         self.mappings[field] = mapping
 
         return mapping
 
+    def set_vectorized(self,field,cache):
+        """
+        Replaces a text field by its pre-vectorized version. The cache is a ReviewCache aligned with the dataset.
+        """
+        if len(cache) != len(self):
+            raise ValueError("Cache holds {} reviews, dataset has {}".format(len(cache),len(self)))
+
+        self.vectorized[field] = cache
+
+    def review_lengths(self,field=2):
+        """
+        Per review (number of sentences, longest sentence, number of words) of a vectorized text field
+        """
+        if field in self.vectorized:
+            return self.vectorized[field].lengths()
+        if hasattr(self.tuplelist,"lengths"):
+            return self.tuplelist.lengths()
+
+        raise ValueError("Review lengths need vectorized reviews (set_vectorized or a TokenStore)")
+
     @staticmethod
-    def build_train_test(datatuples,splits,split_num=0,validation=0):
-        train,test = [],[]
+    def build_train_test(datatuples,splits,split_num=0,validation=0,seed=0):
+        """
+        Train, validation and test sets of split split_num, as index views on datatuples (nothing is copied).
+        Validation (a number of reviews or a fraction of train) is held out of train at random, seeded by seed.
+        """
+        store = datatuples if hasattr(datatuples,"take") else TuplesView(datatuples) # TokenStore or list
+        splits = np.asarray(splits)
 
-        for split,data in tqdm(zip(splits,datatuples),total=len(datatuples),desc="Building train/test of split #{}".format(split_num)):
-            if split == split_num:
-                test.append(data)
-            else:
-                train.append(data)
+        train = np.flatnonzero(splits != split_num)
+        test = np.flatnonzero(splits == split_num)
+
+        if 0 < validation < 1:
+            validation = int(validation * len(train)) # rounds to 0 on small train sets: no validation set
+
+        validation = int(validation)
+        if validation < 0 or (validation > 0 and validation >= len(train)):
+            raise ValueError("Validation set ({} reviews) must be smaller than the train set ({} reviews)".format(validation,len(train)))
 
         if validation > 0:
 
-            if 0 < validation < 1:
-                validation = int(validation * len(train))
+            held = np.zeros(len(train),dtype=bool)
+            held[np.random.RandomState(seed).permutation(len(train))[:validation]] = True
 
-            train = train[:-validation]
-            validation = train[-validation:]
+            return TuplesListDataset(store.take(train[~held])),TuplesListDataset(store.take(train[held])),TuplesListDataset(store.take(test))
 
-            return TuplesListDataset(train),TuplesListDataset(validation),TuplesListDataset(test)
+        return TuplesListDataset(store.take(train)),None,TuplesListDataset(store.take(test)) #None for no pb
 
-        return TuplesListDataset(train),None,TuplesListDataset(test) #None for no pb
+    @staticmethod
+    def folds(datatuples,splits,validation=0,seed=0):
+        """
+        k-fold iteration: (split #, train, validation, test) for each split # in splits, see build_train_test
+        """
+        for split_num in np.unique(splits).tolist():
+            yield (split_num,) + TuplesListDataset.build_train_test(datatuples,splits,split_num,validation,seed)
         
 
 
+class TuplesView(object):
+    """
+    Rows of a list of tuples shared by views (train/validation/test sets): a view only holds row indices.
+    """
+
+    def __init__(self,tuples,indices=None):
+        self.tuples = tuples
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.tuples) if self.indices is None else len(self.indices)
+
+    def __getitem__(self,index):
+        if isinstance(index,slice):
+            return self.take(np.arange(len(self))[index])
+        if self.indices is not None:
+            index = self.indices[index]
+        return self.tuples[index]
+
+    def __iter__(self):
+        if self.indices is None:
+            return iter(self.tuples)
+        return (self.tuples[i] for i in self.indices.tolist())
+
+    def take(self,indices):
+        """
+        View on a subset of rows (indices are relative to this view)
+        """
+        indices = np.asarray(indices,dtype=np.int64)
+        return TuplesView(self.tuples,indices if self.indices is None else self.indices[indices])
+
+
+
+class HashedMapping(dict):
+    """
+    Frequent keys have their own value (offset..base-1), other ones (rare or unseen) share buckets values (base..base+buckets-1)
+    by crc32 of their string form, stable across processes and runs unlike hash(). Without buckets, they all map to 0 (unknown).
+    rows is the size of the embedding table indexed by the mapping.
+    """
+
+    def __init__(self,dedicated,base,buckets=0):
+        super(HashedMapping,self).__init__(dedicated)
+        self.base = base
+        self.buckets = buckets
+        self.rows = base + buckets
+
+    def __missing__(self,key):
+        if self.buckets == 0:
+            return 0
+        return self.base + zlib.crc32(str(key).encode("utf-8")) % self.buckets
+
+    def get(self,key,default=None):
+        return self[key]
+
+    def hashing(self):
+        return {"base":self.base,"buckets":self.buckets}
+
+
+
 class BucketSampler(Sampler):
     """
-    Evenly sample from bucket for datalen
+    Evenly sample from bucket for datalen (or num_samples)
     """
 
-    def __init__(self, dataset,field):
+    def __init__(self, dataset,field,num_samples=None):
         self.dataset = dataset
         self.field = field
         self.index_buckets = self._build_index_buckets()
-        self.len = min([len(x) for x in self.index_buckets.values()])
+        self.len = num_samples if num_samples is not None else min([len(x) for x in self.index_buckets.values()])
 
     def __iter__(self):
         return iter(self.bucket_iterator())
@@ -129,21 +245,476 @@ class BucketSampler(Sampler):
             else:
                 class_index[cl].append(ind)
         return class_index
-        
+
+
+
+class LengthBucketSampler(Sampler):
+    """
+    Batch sampler grouping reviews of similar sentence count and longest sentence to minimise padding.
+    Each epoch, reviews are shuffled, sorted by (sentences//sent_width, longest sentence//word_width) bucket,
+    cut in batches and batches are shuffled. Shuffling is seeded by seed + epoch (see set_epoch).
+    With field set, each epoch first draws a class balanced sample as BucketSampler does.
+    With world_size > 1, every rank computes the same batches and iterates over its own shard (see shard).
+    """
+
+    def __init__(self,dataset,batch_size,field=None,sent_width=1,word_width=4,seed=0,shuffle=True,rank=0,world_size=1):
+        self.batch_size = batch_size
+        self.n_sents,self.max_len,self.n_words = dataset.review_lengths()
+        self.keys = (self.n_sents // sent_width) * (self.max_len.max()//word_width + 1) + self.max_len // word_width
+        self.balance = BucketSampler(dataset,field) if field is not None else None
+        self.seed = seed
+        self.shuffle = shuffle
+        self.rank = rank
+        self.world_size = world_size
+        self.epoch = 0
+        self._batches = None
+
+    def set_epoch(self,epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return len(self.shard())
+
+    def __iter__(self):
+        return iter(self.shard())
+
+    def shard(self):
+        """
+        Batches of this rank: one in world_size. When shuffling (training), the leftover batches are dropped
+        so that all ranks run the same number of steps (gradients are synced at each step).
+        """
+        batches = self.batches()
+        if self.world_size == 1:
+            return batches
+
+        end = len(batches) - len(batches) % self.world_size if self.shuffle else len(batches)
+        return batches[self.rank:end:self.world_size]
+
+    def batches(self):
+        if self._batches is not None and self._batches[0] == self.epoch:
+            return self._batches[1]
+
+        rng = np.random.RandomState(self.seed + self.epoch)
+
+        if self.balance is None:
+            indices = rng.permutation(len(self.keys)) if self.shuffle else np.arange(len(self.keys))
+        else:
+            buckets = [np.asarray(b) for b in self.balance.index_buckets.values()]
+            classes = rng.randint(len(buckets),size=len(self.balance))
+            indices = np.empty(len(classes),dtype=np.int64)
+            for c,b in enumerate(buckets):
+                picked = classes == c
+                indices[picked] = b[rng.randint(len(b),size=picked.sum())]
+
+        indices = indices[np.argsort(self.keys[indices],kind="stable")]
+        batches = self._cut(indices)
+        if self.shuffle:
+            rng.shuffle(batches)
+
+        self._batches = (self.epoch,batches)
+        return batches
+
+    def _cut(self,indices):
+        return [indices[i:i+self.batch_size].tolist() for i in range(0,len(indices),self.batch_size)]
+
+    def padding_ratio(self,batches=None):
+        """
+        Share of padding in the word level (sentences x longest sentence) and sentence level (reviews x most sentences) batches
+        """
+        if batches is None:
+            batches = self.batches()
+
+        words = slots_w = sents = slots_s = 0
+        for b in batches:
+            words += self.n_words[b].sum()
+            slots_w += self.n_sents[b].sum() * self.max_len[b].max()
+            sents += self.n_sents[b].sum()
+            slots_s += len(b) * self.n_sents[b].max()
+
+        return {"words":1 - float(words)/float(slots_w),"sentences":1 - float(sents)/float(slots_s)}
+
+
+
+class TokenBudgetSampler(LengthBucketSampler):
+    """
+    LengthBucketSampler with a budget instead of a fixed number of reviews per batch:
+    max_tokens bounds the padded word level batch (sentences x longest sentence), max_sents its number of sentences.
+    A review over budget makes its own batch.
+    """
+
+    def __init__(self,dataset,max_tokens=None,max_sents=None,**kwargs):
+        if max_tokens is None and max_sents is None:
+            raise ValueError("TokenBudgetSampler needs max_tokens and/or max_sents")
+
+        super(TokenBudgetSampler,self).__init__(dataset,None,**kwargs)
+        self.max_tokens = max_tokens
+        self.max_sents = max_sents
+
+    def _cut(self,indices):
+        batches = []
+        batch,sents,longest = [],0,0
+
+        for i,ns,ml in zip(indices.tolist(),self.n_sents[indices].tolist(),self.max_len[indices].tolist()):
+            over_tokens = self.max_tokens is not None and (sents+ns) * max(longest,ml) > self.max_tokens
+            over_sents = self.max_sents is not None and sents+ns > self.max_sents
+
+            if len(batch) > 0 and (over_tokens or over_sents):
+                batches.append(batch)
+                batch,sents,longest = [],0,0
+
+            batch.append(i)
+            sents += ns
+            longest = max(longest,ml)
+
+        if len(batch) > 0:
+            batches.append(batch)
+
+        return batches
+
+
+
+
+class SkipBatches(Sampler):
+    """
+    Batch sampler wrapper skipping the first skip batches (resuming mid-epoch, see main.py --resume), until skip is reset.
+    The wrapped sampler must give the same batches again (seeded by epoch or by restored random states).
+    """
+
+    def __init__(self,batch_sampler,skip=0):
+        self.batch_sampler = batch_sampler
+        self.skip = skip
+
+    def __len__(self):
+        return max(len(self.batch_sampler) - self.skip,0)
+
+    def __iter__(self):
+        return islice(iter(self.batch_sampler),self.skip,None)
+
+
+
+class ReviewCache(object):
+    """
+    Vectorized reviews as flat arrays:
+    review i is made of sentences rev_offsets[i]:rev_offsets[i+1]
+    sentence j is made of words sent_offsets[j]:sent_offsets[j+1]
+    """
+
+    def __init__(self,words,sent_offsets,rev_offsets):
+        self.words = words
+        self.sent_offsets = sent_offsets
+        self.rev_offsets = rev_offsets
+
+    def __len__(self):
+        return len(self.rev_offsets) - 1
+
+    def __getitem__(self,index):
+        offsets = self.sent_offsets[self.rev_offsets[index]:self.rev_offsets[index+1]+1]
+        if len(offsets) < 2:
+            return []
+        words = torch.from_numpy(np.array(self.words[offsets[0]:offsets[-1]],dtype=np.int64))
+        return list(torch.split(words,np.diff(offsets).tolist()))
+
+    def sent_lengths(self):
+        return np.diff(self.sent_offsets)
+
+    def review_lengths(self):
+        return np.diff(self.rev_offsets)
+
+    def lengths(self,rows=None,max_sents=None,max_words=None):
+        """
+        Per review (number of sentences, longest sentence, number of words), trimmed to max_sents/max_words.
+        Empty reviews count as one word, as they are vectorized as one unknown word.
+        """
+        if rows is None:
+            rows = np.arange(len(self))
+
+        starts = self.rev_offsets[rows]
+        n_sents = self.rev_offsets[rows+1] - starts
+        if max_sents is not None:
+            n_sents = np.minimum(n_sents,max_sents)
+
+        idx = ragged_index(starts,n_sents)
+        sent_lens = self.sent_offsets[idx+1] - self.sent_offsets[idx]
+        if max_words is not None:
+            sent_lens = np.minimum(sent_lens,max_words)
+
+        first = (np.cumsum(n_sents) - n_sents)[n_sents > 0]
+        max_len = np.ones(len(rows),dtype=np.int64)
+        n_words = np.ones(len(rows),dtype=np.int64)
+
+        if len(first) > 0:
+            max_len[n_sents > 0] = np.maximum.reduceat(sent_lens,first)
+            n_words[n_sents > 0] = np.add.reduceat(sent_lens,first)
+
+        return np.maximum(n_sents,1),max_len,n_words
+
+    def save(self,path):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        np.save(os.path.join(path,"words.npy"),self.words)
+        np.save(os.path.join(path,"sent_offsets.npy"),self.sent_offsets)
+        np.save(os.path.join(path,"rev_offsets.npy"),self.rev_offsets)
+
+    @staticmethod
+    def load(path,mmap=True):
+        mode = "r" if mmap else None
+        arrays = [np.load(os.path.join(path,f+".npy"),mmap_mode=mode) for f in ("words","sent_offsets","rev_offsets")]
+        return ReviewCache(*arrays)
+
+    @staticmethod
+    def build(vectorizer,texts,total=None,trim=True):
+        words,sent_lens,rev_lens = [],[],[]
+
+        for review in vectorizer.vectorize_iter(tqdm(texts,desc="Vectorizing",total=total),trim): # one stream: tokenizer batches and processes persist
+            rev_lens.append(len(review))
+            for sent in review:
+                sent_lens.append(len(sent))
+                words.append(sent.numpy().astype(np.int32))
+
+        sent_offsets = np.zeros(len(sent_lens)+1,dtype=np.int64)
+        rev_offsets = np.zeros(len(rev_lens)+1,dtype=np.int64)
+        np.cumsum(sent_lens,out=sent_offsets[1:])
+        np.cumsum(rev_lens,out=rev_offsets[1:])
+
+        return ReviewCache(np.concatenate(words) if words else np.zeros(0,dtype=np.int32),sent_offsets,rev_offsets)
+
+
+
+class TokenStore(object):
+    """
+    Columnar corpus written by prepare_data.py --store, opened through memory maps so that DataLoader workers share pages.
+    Rows are (user,item,review,rating) tuples, reviews being lists of LongTensor sentences.
+    Store word ids follow vocab.json; set_word_dict maps them to a model dictionnary and sets trimming.
+    tokenizer is the tokenizer the reviews were split with (meta.json, spacy for stores written without it).
+    """
+
+    columns = {0:"users",1:"items",3:"ratings"}
+
+    def __init__(self,path,indices=None):
+        self.path = path
+        self.indices = indices
+        self.remap = None
+        self.max_sent_len = None
+        self.max_word_len = None
+        self._open()
+
+        meta = os.path.join(path,"meta.json")
+        self.tokenizer = "spacy"
+        if os.path.exists(meta):
+            with open(meta) as f:
+                self.tokenizer = json.load(f).get("tokenizer","spacy")
+
+    def _open(self):
+        self.reviews = ReviewCache.load(self.path)
+        self.users, self.items, self.ratings, self.splits = [np.load(os.path.join(self.path,c+".npy"),mmap_mode="r") for c in ("users","items","ratings","splits")]
+
+        with open(os.path.join(self.path,"vocab.json")) as f:
+            self.vocab = json.load(f)
+
+    def __getstate__(self): # memory maps are reopened, not pickled, in workers
+        state = self.__dict__.copy()
+        for k in ("reviews","users","items","ratings","splits","vocab"):
+            del state[k]
+        return state
+
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        self._open()
+
+    def __len__(self):
+        return len(self.users) if self.indices is None else len(self.indices)
+
+    def __getitem__(self,index):
+        if isinstance(index,slice):
+            return self.take(np.arange(len(self))[index])
+
+        if self.indices is not None:
+            index = self.indices[index]
+
+        return (int(self.users[index]),int(self.items[index]),self.review(index),int(self.ratings[index]))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def take(self,indices):
+        """
+        View on a subset of rows (indices are relative to this view)
+        """
+        view = TokenStore.__new__(TokenStore)
+        view.__dict__.update(self.__dict__)
+        view.indices = np.asarray(indices,dtype=np.int64) if self.indices is None else self.indices[indices]
+        return view
+
+    def column(self,field):
+        col = getattr(self,self.columns[field])
+        return np.asarray(col) if self.indices is None else col[self.indices]
+
+    def set_word_dict(self,word_dict,max_sent_len=None,max_word_len=None):
+        unk = word_dict["_unk_word_"]
+        self.remap = np.array([word_dict.get(w,unk) for w in self.vocab],dtype=np.int64)
+        self.remap[0] = 0 # padding stays padding
+        self.max_sent_len = max_sent_len
+        self.max_word_len = max_word_len
+
+    def lengths(self):
+        rows = np.arange(len(self.users)) if self.indices is None else self.indices
+        return self.reviews.lengths(rows,self.max_sent_len,self.max_word_len)
+
+    def word_counts(self,chunk_size=100000):
+        """
+        Counts store word ids over the rows of this view
+        """
+        rows = np.arange(len(self.users)) if self.indices is None else self.indices
+        counts = np.zeros(len(self.vocab),dtype=np.int64)
+        rev_off,sent_off = self.reviews.rev_offsets,self.reviews.sent_offsets
+
+        for c in tqdm(range(0,len(rows),chunk_size),desc="Counting words"):
+            r = rows[c:c+chunk_size]
+            starts,ends = sent_off[rev_off[r]],sent_off[rev_off[r+1]]
+            counts += np.bincount(self.reviews.words[ragged_index(starts,ends-starts)],minlength=len(self.vocab))
+
+        return counts
+
+    def review(self,index):
+        review = self.reviews[index]
+
+        if self.max_sent_len is not None:
+            review = review[:self.max_sent_len]
+        if self.max_word_len is not None:
+            review = [s[:self.max_word_len] for s in review]
+        if len(review) == 0:
+            review = [torch.LongTensor([1])] # _unk_word_
+
+        if self.remap is not None:
+            lens = [len(s) for s in review]
+            review = list(torch.from_numpy(self.remap[torch.cat(review).numpy()]).split(lens))
+
+        return review
+
+
+
+def ragged_index(starts,lengths):
+    """
+    Flat index of the concatenated ranges [starts[i],starts[i]+lengths[i])
+    """
+    lengths = np.asarray(lengths,dtype=np.int64)
+    offsets = np.cumsum(lengths) - lengths
+    return np.repeat(np.asarray(starts,dtype=np.int64) - offsets,lengths) + np.arange(lengths.sum())
+
+
+
+TOKENIZERS = ("spacy","sentencizer","regex")
+
+
+class SpacyTokenizer(object):
+    """
+    Lowercased words of texts, sentence by sentence, with spaCy: sentences split by the dependency parser
+    of the full pipeline, or by punctuation rules (sentencizer=True, parser/tagger/ner disabled).
+    Texts go through nlp.pipe by batch_size, in n_process processes.
+    """
+
+    def __init__(self,sentencizer=False,batch_size=1000,n_process=1):
+        import spacy # seconds to import, only when a spaCy tokenizer is used
+
+        self.batch_size = batch_size
+        self.n_process = n_process
+
+        if not sentencizer:
+            self.nlp = spacy.load('en')
+        else:
+            self.nlp = spacy.load('en',disable=["tagger","parser","ner"])
+            try:
+                self.nlp.add_pipe("sentencizer") # spaCy 3
+            except ValueError: # spaCy 2 takes components, not names
+                self.nlp.add_pipe(self.nlp.create_pipe("sentencizer"))
+
+    def _pipe(self,pipe,texts):
+        if self.n_process > 1:
+            return pipe(texts,batch_size=self.batch_size,n_process=self.n_process)
+        return pipe(texts,batch_size=self.batch_size)
+
+    def sentences(self,texts):
+        for doc in self._pipe(self.nlp.pipe,texts):
+            yield [[w.lower_ for w in sent] for sent in doc.sents]
+
+    def words(self,texts):
+        for doc in self._pipe(self.nlp.tokenizer.pipe,texts):
+            yield [w.lower_ for w in doc]
+
+
+class RegexTokenizer(object):
+    """
+    Same interface as SpacyTokenizer without spaCy, following its conventions: contractions are split (do n't, it 's),
+    numbers keep their decimals, punctuation marks are single tokens except ellipses. As with the sentencizer,
+    sentences end after . ! or ? (and the punctuation following them). Much faster, tokens mostly match spaCy's
+    (see benchmarks/bench_tokenizers.py); runs in the calling process.
+    """
+
+    TOKEN = re.compile(r"\d+(?:[.,]\d+)+|\w+?(?=n['’]t\b)|n['’]t\b|['’](?:s|m|d|re|ve|ll)\b|\w+|\.\.+|[^\w\s]")
+    END = set([".","!","?"])
+
+    def sentences(self,texts):
+        for text in texts:
+            sents,sent,ended = [],[],False
+            for w in self.TOKEN.findall(text.lower()):
+                if ended and (w[0].isalnum() or w[0] == "_"):
+                    sents.append(sent)
+                    sent,ended = [],False
+                sent.append(w)
+                ended = ended or w in self.END
+            if len(sent) > 0:
+                sents.append(sent)
+            yield sents
+
+    def words(self,texts):
+        for text in texts:
+            yield self.TOKEN.findall(text.lower())
+
+
+def get_tokenizer(name="spacy",batch_size=1000,n_process=1):
+    if name not in TOKENIZERS:
+        raise ValueError("Unknown tokenizer {}, expected one of {}".format(name,TOKENIZERS))
+    if name == "regex":
+        return RegexTokenizer()
+    return SpacyTokenizer(name == "sentencizer",batch_size,n_process)
 
 
 
 class Vectorizer():
+    """
+    Text to lists of LongTensor sentences of word ids. tokenizer is one of TOKENIZERS (see get_tokenizer),
+    the word dictionnary should be built with the same one. The tokenizer (spaCy model) is only loaded
+    when text is tokenized: not when the dictionnary is given and vectorized reviews are cached.
+    """
+
+    def __init__(self,word_dict=None,max_sent_len=8,max_word_len=32,tokenizer="spacy",n_process=1,batch_size=1000):
+        if tokenizer not in TOKENIZERS:
+            raise ValueError("Unknown tokenizer {}, expected one of {}".format(tokenizer,TOKENIZERS))
 
-    def __init__(self,word_dict=None,max_sent_len=8,max_word_len=32):
         self.word_dict = word_dict
-        self.nlp = spacy.load('en')
+        self.tokenizer = tokenizer
+        self.n_process = n_process
+        self.batch_size = batch_size
+        self._tok = None
         self.max_sent_len = max_sent_len
         self.max_word_len = max_word_len
 
+    @property
+    def tok(self):
+        if self._tok is None:
+            self._tok = get_tokenizer(self.tokenizer,self.batch_size,self.n_process)
+        return self._tok
+
+
+    def count_words(self,data):
+        return Counter(w for d in self.tok.words(tqdm(data,desc="Tokenizing data")) for w in d)
 
     def _get_words_dict(self,data,max_words):
-        word_counter = Counter(w.lower_ for d in self.nlp.tokenizer.pipe((doc for doc in tqdm(data,desc="Tokenizing data"))) for w in d)
+        return self._counter_to_dict(self.count_words(data),max_words)
+
+    def _counter_to_dict(self,word_counter,max_words):
         dict_w =  {w: i for i,(w,_) in tqdm(enumerate(word_counter.most_common(max_words),start=2),desc="building word dict",total=max_words)}
         dict_w["_padding_"] = 0
         dict_w["_unk_word_"] = 1
@@ -153,39 +724,78 @@ class Vectorizer():
     def build_dict(self,text_iterator,max_f):
         self.word_dict = self._get_words_dict(text_iterator,max_f)
 
+    def build_dict_from_store(self,store,max_f):
+        """
+        Same as build_dict, using the word ids of a TokenStore (view) instead of raw text
+        """
+        counts = store.word_counts()
+        self.word_dict = self._counter_to_dict(Counter({store.vocab[i]:int(c) for i,c in enumerate(counts) if i > 1 and c > 0}),max_f)
+
     def vectorize_batch(self,t,trim=True):
-        return self._vect_dict(t,trim)
+        return list(self.vectorize_iter(t,trim))
 
-    def _vect_dict(self,t,trim):
+    def cache_key(self,trim=True):
+        """
+        Hash of everything vectorization depends on: word dictionnary, max_sent_len and max_word_len
+        """
+        h = hashlib.md5()
+        for w,i in sorted(self.word_dict.items()):
+            h.update("{}\t{}\n".format(w,i).encode("utf-8"))
+        h.update("{}-{}-{}".format(self.max_sent_len,self.max_word_len,trim).encode("utf-8"))
+        if self.tokenizer != "spacy": # same keys as before tokenizers were pluggable
+            h.update(self.tokenizer.encode("utf-8"))
+        return h.hexdigest()[:16]
+
+    def vectorize_cached(self,dataset,field,prefix,trim=True):
+        """
+        Vectorizes a dataset text field once and keeps it on disk (prefix_<key>) for the next runs.
+        The key covers the texts themselves and cache_key().
+        """
+        h = hashlib.md5()
+        for text in dataset.field_gen(field):
+            h.update(text.encode("utf-8"))
+            h.update(b"\0")
 
+        path = "{}_{}{}".format(prefix,self.cache_key(trim),h.hexdigest()[:8])
+
+        if os.path.isdir(path):
+            print("-> Loading vectorized reviews from {}".format(path))
+            cache = ReviewCache.load(path)
+        else:
+            cache = ReviewCache.build(self,dataset.field_gen(field),len(dataset),trim)
+            tmp = "{}.tmp{}".format(path,os.getpid())
+            cache.save(tmp)
+            try:
+                os.rename(tmp,path)
+                print("-> Vectorized reviews cached in {}".format(path))
+            except OSError: # another process (distributed training) cached it first
+                shutil.rmtree(tmp)
+
+        return cache
+
+    def vectorize_iter(self,t,trim=True):
+        """
+        Vectorized reviews of an iterable of texts, tokenized in bulk (see get_tokenizer)
+        """
         if self.word_dict is None:
             print("No dictionnary to vectorize text \n-> call method build_dict \n-> or set a word_dict attribute \n first")
             raise Exception
 
-        revs = []
-        for rev in t:
+        unk = self.word_dict["_unk_word_"]
+
+        for sents in self.tok.sentences(t):
             review = []
-            for j,sent in enumerate(self.nlp(rev).sents):  
+            for j,sent in enumerate(sents):
 
                 if trim and j>= self.max_sent_len:
                     break
-                s = []
-                for k,word in enumerate(sent):
-                    word = word.lower_
-
-                    if trim and k >= self.max_word_len:
-                        break
-
-                    if word in self.word_dict:
-                        s.append(self.word_dict[word])
-                    else:
-                        s.append(self.word_dict["_unk_word_"]) #_unk_word_
-                 
+                if trim:
+                    sent = sent[:self.max_word_len]
+
+                s = [self.word_dict.get(word,unk) for word in sent]
+
                 if len(s) >= 1:
                     review.append(torch.LongTensor(s))
             if len(review) == 0:
-                review = [torch.LongTensor([self.word_dict["_unk_word_"]])]        
-            revs.append(review)
-
-        return revs
-
+                review = [torch.LongTensor([unk])] #_unk_word_
+            yield review
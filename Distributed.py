@@ -0,0 +1,121 @@
+import os
+import torch
+import torch.distributed as dist
+
+# Data parallel training on CPU machines with torch.distributed (gloo backend), see main.py --distributed.
+# One process per worker, launched by torchrun which sets RANK/WORLD_SIZE/MASTER_ADDR/MASTER_PORT, e.g. 2 machines x 4 workers:
+#   torchrun --nnodes 2 --nproc-per-node 4 --node-rank <0|1> --master-addr <machine 0> --master-port 29500 main.py --distributed ...
+
+
+def init(backend="gloo"):
+    """
+    Joins the process group, returns (rank, world_size). (0, 1) when not launched by torchrun.
+    """
+    if "WORLD_SIZE" not in os.environ:
+        return 0,1
+
+    dist.init_process_group(backend)
+    return dist.get_rank(),dist.get_world_size()
+
+
+def is_master():
+    return not dist.is_initialized() or dist.get_rank() == 0
+
+
+def broadcast_parameters(net,src=0):
+    """
+    Every worker starts from the weights of worker src (random init, --load or --emb)
+    """
+    for t in list(net.parameters()) + list(net.buffers()):
+        if t.numel() > 0:
+            dist.broadcast(t.data,src)
+
+
+def all_reduce_gradients(net,row_sparse=()):
+    """
+    Averages gradients over workers.
+    Dense gradients are flattened in a single buffer, all-reduced in one call.
+    The gradients of the row_sparse embedding tables are zero except for the rows of the batch words/users/items:
+    workers exchange those rows (all_gather of indices and values) instead of all-reducing the whole table,
+    unless they add up to the table size anyway. Sparse gradients (--sparse) stay sparse.
+    """
+    world_size = dist.get_world_size()
+    tables = set(id(m.weight) for m in row_sparse)
+
+    dense = [p for p in net.parameters() if p.requires_grad and id(p) not in tables]
+    for p in dense:
+        if p.grad is None:
+            p.grad = torch.zeros_like(p)
+
+    flat = torch.cat([p.grad.view(-1) for p in dense])
+    dist.all_reduce(flat)
+    flat.div_(world_size)
+
+    offset = 0
+    for p in dense:
+        p.grad.copy_(flat[offset:offset+p.numel()].view_as(p))
+        offset += p.numel()
+
+    for m in row_sparse:
+        if m.weight.grad is None:
+            m.weight.grad = torch.zeros_like(m.weight).to_sparse(1) if m.sparse else torch.zeros_like(m.weight)
+        grad = m.weight.grad
+
+        if grad.is_sparse: # sparse embeddings (--sparse): rows are given
+            grad = grad.coalesce()
+            rows,vals = _all_gather_rows(grad.indices()[0],grad.values(),world_size)
+            m.weight.grad = torch.sparse_coo_tensor(rows.unsqueeze(0),vals/world_size,grad.size(),check_invariants=False).coalesce()
+            continue
+
+        rows = grad.ne(0).any(1).nonzero().view(-1)
+        rows,vals = _all_gather_rows(rows,grad[rows],world_size,dense_size=grad.size(0))
+        if rows is None: # denser than the table: plain all-reduce
+            dist.all_reduce(grad)
+        else:
+            grad.zero_()
+            grad.index_add_(0,rows,vals)
+        grad.div_(world_size)
+
+
+def _all_gather_rows(rows,vals,world_size,dense_size=None):
+    """
+    Rows (indices and values) of all workers, concatenated. None,None if they add up to more than dense_size.
+    """
+    count = torch.tensor([rows.numel()])
+    counts = [torch.zeros_like(count) for _ in range(world_size)]
+    dist.all_gather(counts,count)
+    counts = [int(c) for c in counts]
+    size = max(counts)
+
+    if dense_size is not None and size * world_size >= dense_size:
+        return None,None
+
+    idx = rows.new_zeros(size)
+    idx[:len(rows)] = rows
+    val = vals.new_zeros(size,vals.size(1))
+    val[:len(rows)] = vals
+
+    all_idx = [torch.zeros_like(idx) for _ in range(world_size)]
+    all_val = [torch.zeros_like(val) for _ in range(world_size)]
+    dist.all_gather(all_idx,idx)
+    dist.all_gather(all_val,val)
+
+    return torch.cat([i[:c] for c,i in zip(counts,all_idx)]),torch.cat([v[:c] for c,v in zip(counts,all_val)])
+
+
+def all_gather_object(obj):
+    """
+    Python objects of all workers, by rank (per worker states of checkpoints)
+    """
+    objs = [None] * dist.get_world_size()
+    dist.all_gather_object(objs,obj)
+    return objs
+
+
+def all_reduce_sum(*values):
+    """
+    Sums python numbers over workers (epoch statistics)
+    """
+    t = torch.tensor(values,dtype=torch.float64)
+    dist.all_reduce(t)
+    return t.tolist()
@@ -1,9 +1,10 @@
+import hashlib
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from operator import itemgetter
-from torch.autograd import Variable
+from typing import List
 from collections import OrderedDict
 
 
@@ -25,17 +26,22 @@ class AttentionalBiGRU(nn.Module):
         
 
     
-    def forward(self, packed_batch,user_embs,item_embs):
+    def forward(self, packed_batch,user_embs,item_embs,bias=None):
         
         rnn_sents,_ = self.gru(packed_batch)
         enc_sents,len_s = torch.nn.utils.rnn.pad_packed_sequence(rnn_sents)
+        return self.pool(enc_sents,len_s,user_embs,item_embs,bias)
 
-        sum_ue = self.att_u(user_embs) + self.att_i(item_embs)
+    def pool(self,enc_sents,len_s,user_embs,item_embs,bias=None):
+        """
+        User/item attention over padded (max_len x n x 2*hid) GRU outputs, the only part of forward that depends on users and items
+        """
+        sum_ue = bias if bias is not None else self.att_u(user_embs) + self.att_i(item_embs)
 
         transformed_h = self.att_h(enc_sents.view(enc_sents.size(0)*enc_sents.size(1),-1))
         summed = F.tanh(sum_ue + transformed_h.view(enc_sents.size()))
         att = self.att_w(summed.view(summed.size(0)*summed.size(1),-1)).view(summed.size(0),summed.size(1)).transpose(0,1)
-        all_att = self._masked_softmax(att,self._list_to_bytemask(list(len_s))).transpose(0,1) # attW,sent 
+        all_att = self._masked_softmax(att,self._lengths_to_mask(len_s,enc_sents.size(0),att.device)).transpose(0,1) # attW,sent 
         attended = all_att.unsqueeze(-1) * enc_sents
         return attended.sum(0,True).squeeze(0)
 
@@ -46,36 +52,174 @@ class AttentionalBiGRU(nn.Module):
         
         emb_h = self.tanh(self.lin(enc_sents.view(enc_sents.size(0)*enc_sents.size(1),-1)))  # Nwords * Emb
         attend = self.att_w(emb_h).view(enc_sents.size(0),enc_sents.size(1)).transpose(0,1)
-        all_att = self._masked_softmax(attend,self._list_to_bytemask(list(len_s))).transpose(0,1) # attW,sent 
+        all_att = self._masked_softmax(attend,self._lengths_to_mask(len_s,enc_sents.size(0),attend.device)).transpose(0,1) # attW,sent 
         attended = all_att.unsqueeze(2).expand_as(enc_sents) * enc_sents
         return attended.sum(0,True).squeeze(0), all_att
 
-    def _list_to_bytemask(self,l):
-        mask = self._buffers['mask'].resize_(len(l),l[0]).fill_(1)
-
-        for i,j in enumerate(l):
-            if j != l[0]:
-                mask[i,j:l[0]] = 0
-
-        return mask
+    def _lengths_to_mask(self,lengths,max_len,device):
+        """
+        (len(lengths) x max_len) boolean mask, True where position < length
+        """
+        lengths = lengths.to(device)
+        return torch.arange(max_len,device=device).unsqueeze(0) < lengths.unsqueeze(1)
     
     def _masked_softmax(self,mat,mask):
+        """
+        Softmax on dim 1 over unmasked positions. Masked logits are set to -inf so they get exactly 0,
+        F.softmax subtracts the row max before exponentiating (no overflow on large logits).
+        """
+        return F.softmax(mat.masked_fill(~mask,float("-inf")),1)
+
+
+
+class WeightsVersion(object):
+    """
+    Version of the values of a list of tensors: a hash of their contents, only recomputed when one of them was updated in
+    place (optimizer step, load_state_dict) or replaced (.data =). Loading the same values again keeps the version.
+    """
+
+    def __init__(self):
+        self.key = None
+        self.digest = None
+
+    def __call__(self,params):
+        params = list(params)
+        key = tuple((p.data_ptr(),p._version) for p in params)
+        if key != self.key:
+            h = hashlib.md5()
+            for p in params:
+                h.update(p.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+            self.key = key
+            self.digest = h.hexdigest()
+        return self.digest
+
+
+class BiasCache(object):
+    """
+    LRU cache (at most max_size ids) of the projected attention biases att(table(id)) of one AttentionalBiGRU projection.
+    Inference only: entries hold no graph, and are all dropped as soon as the values of the projection or table weights
+    change (optimizer step, load_state_dict, set_emb_tensor...).
+    """
+
+    def __init__(self,proj,table,max_size=100000):
+        self.proj = proj
+        self.table = table
+        self.max_size = max_size
+        self.rows = OrderedDict()
+        self.weights = WeightsVersion()
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self,ids):
+        """
+        (len(ids) x natt) biases of a LongTensor of ids
+        """
+        version = self.weights([self.table.weight] + list(self.proj.parameters()))
+        if version != self.version:
+            self.clear()
+            self.version = version
+
+        keys = ids.tolist()
+        missing = sorted(set(k for k in keys if k not in self.rows))
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+
+        if len(missing) > 0:
+            with torch.no_grad():
+                new = self.proj(self.table.weight[torch.tensor(missing,device=ids.device)])
+            self.rows.update((k,new[j].clone()) for j,k in enumerate(missing)) # own storage: evicting a row frees it
+
+        for k in keys:
+            self.rows.move_to_end(k)
+        out = torch.stack([self.rows[k] for k in keys])
+
+        while len(self.rows) > self.max_size:
+            self.rows.popitem(last=False)
 
-        exp = torch.exp(mat) * Variable(mask,requires_grad=False)
-        sum_exp = exp.sum(1,True)+0.0001
-     
-        return exp/sum_exp.expand_as(exp)
+        return out
 
+    def clear(self):
+        self.rows.clear()
+
+    def stats(self):
+        return {"size":len(self.rows),"hits":self.hits,"misses":self.misses,"hit_rate":self.hits/max(self.hits+self.misses,1)}
+
+
+class SentenceCache(object):
+    """
+    LRU cache of word-level BiGRU outputs (len x 2*hid) per sentence, keyed by the sentence token ids, at most max_bytes of outputs.
+    They don't depend on users or items: a re-scored sentence only goes through the attention pooling again.
+    Inference only: entries are all dropped as soon as the values of the word embeddings or GRU weights change,
+    reloading a model whose upper layers (sent, lin_out, users, items) only changed keeps them.
+    """
+
+    def __init__(self,embed,gru,max_bytes=256*2**20):
+        self.embed = embed
+        self.gru = gru
+        self.max_bytes = max_bytes
+        self.rows = OrderedDict()
+        self.weights = WeightsVersion()
+        self.version = None
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self,batch,lengths):
+        """
+        Padded (max_len x n x 2*hid) GRU outputs and lengths of a (n x max_len) batch of sentences, as pad_packed_sequence returns them
+        """
+        version = self.weights([self.embed.weight] + list(self.gru.parameters()))
+        if version != self.version:
+            self.clear()
+            self.version = version
+
+        tokens = batch.cpu().numpy()
+        keys = [tokens[j,:l].tobytes() for j,l in enumerate(lengths)]
+
+        missing = OrderedDict()
+        for j,k in enumerate(keys):
+            if k not in self.rows and k not in missing:
+                missing[k] = j
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+
+        if len(missing) > 0:
+            idx = list(missing.values())
+            with torch.no_grad():
+                packed = torch.nn.utils.rnn.pack_padded_sequence(self.embed(batch[idx]),[lengths[j] for j in idx],batch_first=True,enforce_sorted=False)
+                enc,_ = torch.nn.utils.rnn.pad_packed_sequence(self.gru(packed)[0])
+
+            for n,(k,j) in enumerate(missing.items()):
+                self.rows[k] = enc[:lengths[j],n].clone()
+                self.nbytes += self.rows[k].numel() * self.rows[k].element_size()
+
+        for k in keys:
+            self.rows.move_to_end(k)
+        enc_sents = torch.nn.utils.rnn.pad_sequence([self.rows[k] for k in keys])
+
+        while self.nbytes > self.max_bytes and len(self.rows) > 0:
+            _,row = self.rows.popitem(last=False)
+            self.nbytes -= row.numel() * row.element_size()
+
+        return enc_sents,torch.tensor(lengths)
+
+    def clear(self):
+        self.rows.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        return {"size":len(self.rows),"mbytes":self.nbytes/2**20,"hits":self.hits,"misses":self.misses,"hit_rate":self.hits/max(self.hits+self.misses,1)}
 
 
 class HierarchicalDoc(nn.Module):
 
-    def __init__(self, ntoken, nusers, nitems, num_class, emb_size=200, hid_size=50):
+    def __init__(self, ntoken, nusers, nitems, num_class, emb_size=200, hid_size=50, sparse=False):
         super(HierarchicalDoc, self).__init__()
 
-        self.embed = nn.Embedding(ntoken, emb_size, padding_idx=0)
-        self.users = nn.Embedding(nusers, emb_size)
-        self.items = nn.Embedding(nitems, emb_size)
+        self.embed = nn.Embedding(ntoken, emb_size, padding_idx=0, sparse=sparse) # sparse: gradients only hold the rows of the batch
+        self.users = nn.Embedding(nusers, emb_size, sparse=sparse)
+        self.items = nn.Embedding(nitems, emb_size, sparse=sparse)
 
         self.word = AttentionalBiGRU(emb_size, emb_size//2)
         self.sent = AttentionalBiGRU(emb_size, emb_size//2)
@@ -83,6 +227,40 @@ class HierarchicalDoc(nn.Module):
         self.emb_size = emb_size
         self.lin_out = nn.Linear(emb_size,num_class)
         self.register_buffer("reviews",torch.Tensor())
+        self.bias_cache = None
+        self.sentence_cache = None
+
+
+    def enable_bias_cache(self,max_size=100000):
+        """
+        In eval mode, gathers the user/item attention biases of both levels from per-id LRU caches
+        instead of running the att_u/att_i projections on every batch.
+        """
+        self.bias_cache = {(level,kind):BiasCache(getattr(att,"att_"+kind[0]),getattr(self,kind),max_size)
+                           for level,att in (("word",self.word),("sent",self.sent)) for kind in ("users","items")}
+
+    def disable_bias_cache(self):
+        self.bias_cache = None
+
+    def enable_sentence_cache(self,max_mbytes=256):
+        """
+        In eval mode, reuses the word-level GRU outputs of sentences already seen (same token ids, same weights)
+        and only runs the user/item attention on them.
+        """
+        self.sentence_cache = SentenceCache(self.embed,self.word.gru,int(max_mbytes*2**20))
+
+    def disable_sentence_cache(self):
+        self.sentence_cache = None
+
+    def _cached_bias(self,level,users,items):
+        return self.bias_cache[(level,"users")](users) + self.bias_cache[(level,"items")](items)
+
+
+    def exportable(self):
+        """
+        Tensor only version of this network (same weights), see ExportableDoc
+        """
+        return ExportableDoc(self)
 
 
     def set_emb_tensor(self,emb_tensor):
@@ -91,53 +269,62 @@ class HierarchicalDoc(nn.Module):
 
         
     def _reorder_sent(self,sents,stats):
-        
-        sort_r = sorted([(l,r,s,i) for i,(l,r,s) in enumerate(stats)], key=itemgetter(0,1,2)) #(len(r),r#,s#)
-        builder = OrderedDict()
-        
-        for (l,r,s,i) in sort_r:
-            if r not in builder:
-                builder[r] = [i]
-            else:
-                builder[r].append(i)
-                
-        list_r = list(reversed(builder))
-        
-        revs = Variable(self._buffers["reviews"].resize_(len(builder),len(builder[list_r[0]]),sents.size(1)).fill_(0), requires_grad=False)
-        lens = []
-        review_order = []
-        
-        for i,x in enumerate(list_r):
-            revs[i,0:len(builder[x]),:] = sents[builder[x],:]
-            lens.append(len(builder[x]))
-            review_order.append(x)
+        """
+        Scatters sentence embeddings in a padded (n_reviews x max_sents x emb) tensor.
+        Reviews are ordered by (length, review #) decreasing: review_order holds review numbers, real_order its inverse permutation.
+        """
+        lr,rn,sn = (torch.tensor(x,device=sents.device) for x in zip(*stats))
+        n_revs = int(rn.max()) + 1
+        rev_num = torch.arange(n_revs,device=sents.device)
+
+        rev_lens = torch.zeros_like(rev_num).scatter_(0,rn,lr)
+        _,review_order = torch.sort(rev_lens * n_revs + rev_num,descending=True)
+        real_order = torch.empty_like(review_order).scatter_(0,review_order,rev_num)
+
+        revs = sents.new_zeros(n_revs,int(rev_lens.max()),sents.size(1))
+        revs[real_order[rn],sn] = sents
+        lens = rev_lens[review_order].tolist()
 
-        real_order = sorted(range(len(review_order)), key=lambda k: review_order[k])
-        
         return revs,lens,real_order,review_order
         
     
     def forward(self, batch_reviews,users,items,stats):
         ls,lr,rn,sn = zip(*stats)
-        emb_w = F.dropout(self.embed(batch_reviews),training=self.training)
-        emb_u = F.dropout(self.users(users),training=self.training)
-        emb_i = F.dropout(self.items(items),training=self.training)
-        
-        packed_sents = torch.nn.utils.rnn.pack_padded_sequence(emb_w, ls,batch_first=True)
-
-        reordered_u = emb_u[rn,:]
-        reordered_i = emb_i[rn,:]
-        sent_embs = self.word(packed_sents,reordered_u,reordered_i)
+        cache_sents = self.sentence_cache is not None and not self.training
+        cache_bias = self.bias_cache is not None and not self.training
+
+        if not cache_sents:
+            emb_w = F.dropout(self.embed(batch_reviews),training=self.training)
+            packed_sents = torch.nn.utils.rnn.pack_padded_sequence(emb_w, ls,batch_first=True)
+
+        if cache_bias:
+            reordered_u = reordered_i = None
+            bias = self._cached_bias("word",users,items)[rn,:]
+        else:
+            emb_u = F.dropout(self.users(users),training=self.training)
+            emb_i = F.dropout(self.items(items),training=self.training)
+            reordered_u = emb_u[rn,:]
+            reordered_i = emb_i[rn,:]
+            bias = None
+
+        if cache_sents:
+            enc_sents,len_s = self.sentence_cache(batch_reviews,ls)
+            sent_embs = self.word.pool(enc_sents,len_s,reordered_u,reordered_i,bias)
+        else:
+            sent_embs = self.word(packed_sents,reordered_u,reordered_i,bias)
         
 
         rev_embs,lens,real_order,review_order = self._reorder_sent(sent_embs,zip(lr,rn,sn))
 
         packed_rev = torch.nn.utils.rnn.pack_padded_sequence(rev_embs, lens,batch_first=True)
 
-        reordered_u = emb_u[review_order,:]
-        reordered_i = emb_i[review_order,:]
+        if cache_bias:
+            bias = self._cached_bias("sent",users[review_order],items[review_order])
+        else:
+            reordered_u = emb_u[review_order,:]
+            reordered_i = emb_i[review_order,:]
 
-        doc_embs = self.sent(packed_rev,reordered_u,reordered_i)
+        doc_embs = self.sent(packed_rev,reordered_u,reordered_i,bias)
 
         final_emb = doc_embs[real_order,:]
         out = self.lin_out(final_emb)
@@ -152,7 +339,7 @@ class HierarchicalDoc(nn.Module):
         packed_sents = torch.nn.utils.rnn.pack_padded_sequence(emb_w, ls,batch_first=True)
         sent_embs,att_w = self.word.forward_att(packed_sents)
         
-        rev_embs,lens,real_order = self._reorder_sent(sent_embs,zip(lr,rn,sn))
+        rev_embs,lens,real_order,_ = self._reorder_sent(sent_embs,zip(lr,rn,sn))
 
         packed_rev = torch.nn.utils.rnn.pack_padded_sequence(rev_embs, lens,batch_first=True)
         doc_embs,att_s = self.sent.forward_att(packed_rev)
@@ -166,4 +353,69 @@ class HierarchicalDoc(nn.Module):
 
 
 
+class ExportableAttention(nn.Module):
+    """
+    One level of ExportableDoc: the BiGRU and user/item attention of an AttentionalBiGRU (shared weights), on padded
+    (batch x time x emb) sequences. Each GRU direction runs on its own: the backward one on sequences reversed
+    within their length, so padding never reaches the outputs of valid positions.
+    """
+
+    def __init__(self,att):
+        super(ExportableAttention, self).__init__()
+        self.gru = att.gru
+        self.att_w = att.att_w
+        self.att_u = att.att_u
+        self.att_h = att.att_h
+        self.att_i = att.att_i
+
+    def _direction(self,x,weights:List[torch.Tensor]):
+        h0 = x.new_zeros(1,x.size(0),self.gru.hidden_size)
+        out,_ = torch.gru(x,h0,weights,True,1,0.0,False,False,True)
+        return out
+
+    def forward(self,x,lengths,user_embs,item_embs):
+        steps = torch.arange(x.size(1),device=x.device).unsqueeze(0)
+        valid = steps < lengths.unsqueeze(1)
+        rev = torch.where(valid,lengths.unsqueeze(1)-1-steps,steps).unsqueeze(2).expand(x.size(0),x.size(1),self.gru.hidden_size)
+
+        g = self.gru
+        fwd = self._direction(x,[g.weight_ih_l0,g.weight_hh_l0,g.bias_ih_l0,g.bias_hh_l0])
+        bwd = self._direction(x.gather(1,rev[:,:,:1].expand_as(x)),[g.weight_ih_l0_reverse,g.weight_hh_l0_reverse,g.bias_ih_l0_reverse,g.bias_hh_l0_reverse]).gather(1,rev)
+        enc = torch.cat([fwd,bwd],2)
+
+        summed = torch.tanh(self.att_u(user_embs).unsqueeze(1) + self.att_i(item_embs).unsqueeze(1) + self.att_h(enc))
+        att = self.att_w(summed).squeeze(2).masked_fill(~valid,float("-inf"))
+        return (F.softmax(att,1).unsqueeze(2) * enc).sum(1)
+
+
+class ExportableDoc(nn.Module):
+    """
+    Tensor only HierarchicalDoc.forward (shared weights) for TorchScript and ONNX export: no python stats, sorting or packing.
+    tokens: (n_sents x max_len) sentences, consecutive per review, reviews in order
+    sent_lens: (n_sents) sentence lengths, sent_review: (n_sents) review # of each sentence
+    users, items: (n_reviews) ids. Returns (n_reviews x num_class) logits.
+    """
+
+    def __init__(self,net):
+        super(ExportableDoc, self).__init__()
+        self.embed = net.embed
+        self.users = net.users
+        self.items = net.items
+        self.word = ExportableAttention(net.word)
+        self.sent = ExportableAttention(net.sent)
+        self.lin_out = net.lin_out
+
+    def forward(self,tokens,sent_lens,sent_review,users,items):
+        emb_u = self.users(users)
+        emb_i = self.items(items)
+        sent_embs = self.word(self.embed(tokens),sent_lens,emb_u[sent_review],emb_i[sent_review])
+
+        rev_lens = torch.zeros_like(users).scatter_add(0,sent_review,torch.ones_like(sent_review))
+        starts = torch.cumsum(rev_lens,0) - rev_lens
+        position = torch.arange(sent_review.size(0),device=tokens.device) - starts[sent_review]
+
+        revs = sent_embs.new_zeros(users.size(0),int(rev_lens.max()),sent_embs.size(1)) # export scripted: traced, this size is frozen
+        revs = revs.index_put((sent_review,position),sent_embs)
+
+        return self.lin_out(self.sent(revs,rev_lens,emb_u,emb_i))
 
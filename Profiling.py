@@ -0,0 +1,159 @@
+import sys
+import json
+import time
+
+from collections import defaultdict
+from contextlib import contextmanager
+
+import torch
+
+try:
+    import resource
+except ImportError: # not on windows: no peak RSS
+    resource = None
+
+# Training loop instrumentation, see main.py --profile.
+# Wall time per stage (averaged per step over a window of --profile-every steps), DataLoader wait, reviews/sec,
+# tokens/sec, padding ratios and peak RSS are written as one json line per window. Stages of a step:
+#   wait       main process waiting for the DataLoader (batches not ready)
+#   collate    collate function (vectorization, padding), in the DataLoader workers: overlaps with training
+#   h2d        copies to the training tensors (host to device with --cuda)
+#   embed      word/user/item embeddings and sentence packing        \
+#   word       word level GRU and attention                           |  forward, timed by
+#   reorder    sentences to padded reviews (_reorder_sent), packing   |  hooks on the network
+#   sent       sentence level GRU and attention                       |
+#   output     output layer                                          /
+#   loss       loss and accuracy
+#   backward   backward pass (and gradient all-reduce with --distributed)
+#   optimizer  optimizer step
+#   checkpoint state snapshot with --checkpoint-every (written in the background)
+# A torch.profiler trace (chrome://tracing, perfetto) can also be exported for a window of steps.
+
+
+class Profiler(object):
+
+    def __init__(self,out=None,every=50,cuda=False,rank=None,trace=None,trace_window=(10,5)):
+        self.out = out if out is not None else sys.stdout
+        self.every = every
+        self.cuda = cuda
+        self.rank = rank
+        self._reset()
+
+        self.trace = None
+        if trace is not None:
+            start,steps = trace_window
+            activities = [torch.profiler.ProfilerActivity.CPU] + ([torch.profiler.ProfilerActivity.CUDA] if cuda else [])
+            self.trace = torch.profiler.profile(activities=activities,record_shapes=True,
+                                                schedule=torch.profiler.schedule(wait=max(start-1,0),warmup=1 if start > 0 else 0,active=steps,repeat=1),
+                                                on_trace_ready=lambda p: p.export_chrome_trace(trace))
+            self.trace.start()
+
+    def _reset(self):
+        self.times = defaultdict(float)
+        self.start = time.perf_counter()
+        self.window = 0
+        self.reviews = self.tokens = self.word_slots = self.sents = self.sent_slots = 0
+
+    def _now(self):
+        if self.cuda:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    @contextmanager
+    def stage(self,name):
+        start = self._now()
+        if self.trace is not None:
+            with torch.profiler.record_function(name):
+                yield
+        else:
+            yield
+        self.times[name] += self._now() - start
+
+    def attach(self,net):
+        """
+        Times the forward stages of a HierarchicalDoc with hooks (see header). Returns the hook handles.
+        """
+        last = [0.]
+
+        def mark(name=None):
+            def hook(*_):
+                now = self._now()
+                if name is not None:
+                    self.times[name] += now - last[0]
+                last[0] = now
+            return hook
+
+        return [net.register_forward_pre_hook(mark()),
+                net.word.register_forward_pre_hook(mark("embed")),net.word.register_forward_hook(mark("word")),
+                net.sent.register_forward_pre_hook(mark("reorder")),net.sent.register_forward_hook(mark("sent")),
+                net.register_forward_hook(mark("output"))]
+
+    def collate(self,fn):
+        """
+        Collate function also returning its run time (measured in the DataLoader worker)
+        """
+        def timed(l):
+            start = time.perf_counter()
+            batch = fn(l)
+            return batch,time.perf_counter() - start
+        return timed
+
+    def iterate(self,batches):
+        """
+        Batches of a DataLoader using a collate function wrapped by collate, timing the waits
+        """
+        batches = iter(batches)
+        self._reset() # windows do not span epochs (see emit), time before the first one is not counted
+        while True:
+            start = time.perf_counter()
+            try:
+                batch,collate = next(batches)
+            except StopIteration:
+                return
+            self.times["wait"] += time.perf_counter() - start
+            self.times["collate"] += collate
+            yield batch
+
+    def step(self,epoch,iteration,batch_t,stat):
+        """
+        Ends a step on a padded batch (see main.pad_batch), writes a json line every self.every steps
+        """
+        lens = [s[0] for s in stat]
+        rev_lens = {s[2]:s[1] for s in stat}
+
+        self.window += 1
+        self.reviews += len(rev_lens)
+        self.tokens += sum(lens)
+        self.word_slots += batch_t.numel()
+        self.sents += len(stat)
+        self.sent_slots += len(rev_lens) * max(rev_lens.values())
+
+        if self.trace is not None:
+            self.trace.step()
+
+        if self.window >= self.every:
+            self.emit(epoch,iteration)
+
+    def emit(self,epoch,iteration):
+        if self.window == 0:
+            return
+
+        elapsed = time.perf_counter() - self.start
+        record = {"epoch":epoch,"iteration":iteration,"steps":self.window,"seconds":elapsed,
+                  "stages_ms":{k:v/self.window*1e3 for k,v in sorted(self.times.items())},
+                  "reviews_per_s":self.reviews/elapsed,"tokens_per_s":self.tokens/elapsed,
+                  "padding":{"words":1-self.tokens/float(self.word_slots),"sentences":1-self.sents/float(self.sent_slots)},
+                  "peak_rss_mb":resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024. if resource is not None else None}
+        if self.rank is not None:
+            record["rank"] = self.rank
+
+        self.out.write(json.dumps(record) + "\n")
+        self.out.flush()
+        self._reset()
+
+    def close(self):
+        if self.trace is not None:
+            self.trace.stop()
+            self.trace = None
+        if self.out is not sys.stdout:
+            self.out.close()
@@ -0,0 +1,73 @@
+import os
+import sys
+import argparse
+import timeit
+
+import torch
+import numpy as np
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),".."))
+from main import tuple_batcher_builder
+
+# Times the collate function (padding + sorting of a batch) against the former per-token implementation.
+
+
+def legacy_tuple_batch(l):
+    user,item,review,rating = zip(*l)
+    r_t = torch.Tensor(rating).long()
+    u_t = torch.Tensor(user).long()
+    i_t = torch.Tensor(item).long()
+    list_rev = review
+
+    stat =  sorted([(len(s),len(r),r_n,s_n,s) for r_n,r in enumerate(list_rev) for s_n,s in enumerate(r)],reverse=True,key=lambda x:x[:4])
+
+    max_len = stat[0][0]
+    batch_t = torch.zeros(len(stat),max_len).long()
+
+    for i,s in enumerate(stat):
+        for j,w in enumerate(s[-1]):
+            batch_t[i,j] = w
+
+    stat = [(ls,lr,r_n,s_n) for ls,lr,r_n,s_n,_ in stat]
+
+    return batch_t,r_t,u_t,i_t,stat,review
+
+
+def random_batch(b_size,max_sents,max_words,n_words,rng):
+    batch = []
+    for _ in range(b_size):
+        review = [torch.from_numpy(rng.randint(2,n_words,size=rng.randint(1,max_words+1))) for _ in range(rng.randint(1,max_sents+1))]
+        batch.append((rng.randint(0,1000),rng.randint(0,1000),review,rng.randint(0,5)))
+    return batch
+
+
+def main(args):
+    rng = np.random.RandomState(args.seed)
+    batches = [random_batch(args.b_size,args.max_sents,args.max_words,args.n_words,rng) for _ in range(args.n_batches)]
+    tuple_batch = tuple_batcher_builder()
+
+    for b in batches:
+        new,old = tuple_batch(b),legacy_tuple_batch(b)
+        assert torch.equal(new[0],old[0]) and new[4] == old[4], "collate outputs differ"
+
+    t_old = min(timeit.repeat(lambda: [legacy_tuple_batch(b) for b in batches],number=1,repeat=args.repeat))
+    t_new = min(timeit.repeat(lambda: [tuple_batch(b) for b in batches],number=1,repeat=args.repeat))
+
+    print("{} batches of {} reviews (<= {} sentences of <= {} words)".format(args.n_batches,args.b_size,args.max_sents,args.max_words))
+    print("legacy  : {:.2f} ms/batch".format(1000*t_old/args.n_batches))
+    print("current : {:.2f} ms/batch".format(1000*t_new/args.n_batches))
+    print("speedup : x{:.1f}".format(t_old/t_new))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--b-size", type=int, default=32)
+    parser.add_argument("--max-sents", type=int, default=16)
+    parser.add_argument("--max-words", type=int, default=32)
+    parser.add_argument("--n-words", type=int, default=10000)
+    parser.add_argument("--n-batches", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1337)
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,94 @@
+import os
+import sys
+import argparse
+import timeit
+
+import torch
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),".."))
+from Nets import AttentionalBiGRU
+
+# Times the attention masked softmax (forward + backward) against the former exp * mask implementation,
+# at word level (n_sents x max_words) and sentence level (b_size x max_sents).
+
+
+def legacy_masked_softmax(mat,mask):
+    exp = torch.exp(mat) * mask.float()
+    sum_exp = exp.sum(1,True)+0.0001
+    return exp/sum_exp.expand_as(exp)
+
+
+def peak_memory(fn,cuda):
+    """
+    Peak memory allocated while running fn (bytes)
+    """
+    if cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+        fn()
+        torch.cuda.synchronize()
+        return torch.cuda.max_memory_allocated() - base
+
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU],profile_memory=True) as prof:
+        fn()
+
+    current = peak = 0
+    for evt in sorted(prof.events(),key=lambda e:e.time_range.start):
+        current += evt.cpu_memory_usage if not evt.cpu_children else 0
+        peak = max(peak,current)
+    return peak
+
+
+def run(name,softmax,logits,mask,args):
+    def step():
+        mat = logits.clone().requires_grad_()
+        softmax(mat,mask).sum().backward()
+        if args.cuda:
+            torch.cuda.synchronize()
+
+    step()
+    t = min(timeit.repeat(step,number=args.number,repeat=args.repeat)) / args.number
+    mem = peak_memory(step,args.cuda)
+    return t,mem
+
+
+def main(args):
+    torch.manual_seed(args.seed)
+    device = "cuda" if args.cuda else "cpu"
+    att = AttentionalBiGRU(8,4)
+    n_sents = args.b_size * args.avg_sents
+
+    levels = (("word",n_sents,args.max_words),("sentence",args.b_size,args.max_sents))
+
+    for level,rows,cols in levels:
+        logits = (torch.randn(rows,cols) * args.scale).to(device)
+        lengths = torch.randint(1,cols+1,(rows,))
+        lengths[0] = cols
+        mask = att._lengths_to_mask(lengths,cols,device)
+
+        for name,softmax in (("legacy",legacy_masked_softmax),("current",att._masked_softmax)):
+            t,mem = run(name,softmax,logits,mask,args)
+            out = softmax(logits,mask)
+            finite = bool(torch.isfinite(out).all())
+            print("{:8} {:8} ({}x{}) : {:8.1f} us  peak {:8.1f} KiB  finite={}".format(level,name,rows,cols,t*1e6,mem/1024,finite))
+
+    big = torch.full((2,4),100.).to(device)
+    full = torch.ones(2,4,dtype=torch.bool,device=device)
+    print("logits of 100: legacy {} / current {}".format(legacy_masked_softmax(big,full)[0].tolist(),att._masked_softmax(big,full)[0].tolist()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--b-size", type=int, default=32)
+    parser.add_argument("--avg-sents", type=int, default=8)
+    parser.add_argument("--max-sents", type=int, default=16)
+    parser.add_argument("--max-words", type=int, default=32)
+    parser.add_argument("--scale", type=float, default=3, help="std of the random logits")
+    parser.add_argument("--number", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1337)
+    parser.add_argument('--cuda', action='store_true')
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,68 @@
+import os
+import sys
+import argparse
+import timeit
+
+import torch
+import torch.optim as optim
+import numpy as np
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),".."))
+from Nets import HierarchicalDoc
+from main import tuple_batcher_builder, SplitOptimizer
+from bench_collate import random_batch
+
+# Times a training step (forward + backward + optimizer) with dense embeddings and Adam against
+# sparse embeddings and SparseAdam (main.py --sparse), for growing user/item tables.
+
+
+def grad_bytes(net):
+    total = 0
+    for p in (net.embed.weight,net.users.weight,net.items.weight):
+        g = p.grad.coalesce().values() if p.grad.is_sparse else p.grad
+        total += g.numel() * g.element_size()
+    return total
+
+
+def run(n_ids,sparse,batch,args):
+    torch.manual_seed(args.seed)
+    net = HierarchicalDoc(args.n_words,n_ids,n_ids,5,emb_size=args.emb_size,sparse=sparse)
+    optimizer = SplitOptimizer(net) if sparse else optim.Adam(net.parameters())
+    criterion = torch.nn.CrossEntropyLoss()
+    batch_t,r_t,u_t,i_t,stat,_ = batch
+
+    def step():
+        optimizer.zero_grad()
+        criterion(net(batch_t,u_t,i_t,stat),r_t).backward()
+        optimizer.step()
+
+    step()
+    t = min(timeit.repeat(step,number=args.number,repeat=args.repeat)) / args.number
+    return t,grad_bytes(net)
+
+
+def main(args):
+    rng = np.random.RandomState(args.seed)
+    batch = tuple_batcher_builder()(random_batch(args.b_size,args.max_sents,args.max_words,args.n_words,rng))
+
+    for n_ids in args.ids:
+        batch = batch[:2] + (torch.from_numpy(rng.randint(0,n_ids,args.b_size)),torch.from_numpy(rng.randint(0,n_ids,args.b_size))) + batch[4:]
+        for sparse in (False,True):
+            t,g = run(n_ids,sparse,batch,args)
+            print("{:>9} users/items {:6} : {:8.1f} ms/step  embedding grads {:10.1f} KiB".format(n_ids,"sparse" if sparse else "dense",t*1e3,g/1024))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ids", type=int, nargs="+", default=[10000,100000], help="user and item table sizes")
+    parser.add_argument("--n-words", type=int, default=10000)
+    parser.add_argument("--emb-size", type=int, default=200)
+    parser.add_argument("--b-size", type=int, default=32)
+    parser.add_argument("--max-sents", type=int, default=8)
+    parser.add_argument("--max-words", type=int, default=16)
+    parser.add_argument("--number", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1337)
+    args = parser.parse_args()
+
+    main(args)
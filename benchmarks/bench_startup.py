@@ -0,0 +1,76 @@
+import os
+import re
+import sys
+import argparse
+import subprocess
+import time
+
+# Startup cost of the repo modules and of the first vectorized batch, each in a fresh interpreter (cold imports):
+# wall time, import time of the module (python -X importtime) and its heaviest direct imports.
+# spaCy and gensim should not show up unless a spaCy tokenizer is actually used.
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)),"..")
+LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+FIRST_BATCH = """
+from Data import Vectorizer
+v = Vectorizer({{"_padding_":0,"_unk_word_":1,"good":2}},tokenizer="{}")
+v.vectorize_batch(["A good start. Then a second sentence!"])
+"""
+
+
+def run(code,python):
+    start = time.perf_counter()
+    proc = subprocess.run([python,"-X","importtime","-c",code],cwd=ROOT,stderr=subprocess.PIPE,stdout=subprocess.DEVNULL,universal_newlines=True)
+    elapsed = time.perf_counter() - start
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1])
+
+    imports = []
+    for line in proc.stderr.splitlines():
+        m = LINE.match(line)
+        if m:
+            imports.append((int(m.group(2))/1e6,len(m.group(3))//2,m.group(4)))
+    return elapsed,imports
+
+
+def report(name,code,args):
+    best = None
+    for _ in range(args.repeat):
+        try:
+            elapsed,imports = run(code,args.python)
+        except RuntimeError as e: # e.g. spaCy model not installed
+            print("{:24} failed: {}".format(name,e))
+            return
+        if best is None or elapsed < best[0]:
+            best = (elapsed,imports)
+
+    elapsed,imports = best
+    total = sum(t for t,level,_ in imports if level == 0)
+    packages = {}
+    for t,level,m in imports: # a package root line holds the cost of its first import, wherever it happens
+        if level > 0 and "." not in m:
+            packages[m] = max(packages.get(m,0),t)
+    heaviest = sorted(((t,m) for m,t in packages.items() if t > args.min_ms/1e3),reverse=True)[:args.top]
+
+    print("{:24} {:7.2f} s wall  {:7.2f} s imports  | {}".format(name,elapsed,total,"  ".join("{} {:.2f}".format(m,t) for t,m in heaviest)))
+
+
+def main(args):
+    for module in args.modules:
+        report("import "+module,"import "+module,args)
+    for tokenizer in args.tokenizers:
+        report("first batch ("+tokenizer+")",FIRST_BATCH.format(tokenizer),args)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--modules", nargs="+", default=["Data","Nets","main","score","server"])
+    parser.add_argument("--tokenizers", nargs="+", default=["regex","sentencizer","spacy"], help="tokenizers timed up to their first vectorized batch")
+    parser.add_argument("--python", type=str, default=sys.executable)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--top", type=int, default=4, help="heaviest imports shown (seconds)")
+    parser.add_argument("--min-ms", type=float, default=50)
+    args = parser.parse_args()
+
+    main(args)
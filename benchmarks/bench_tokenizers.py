@@ -0,0 +1,87 @@
+import os
+import sys
+import time
+import argparse
+
+from difflib import SequenceMatcher
+
+import numpy as np
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),".."))
+from Data import Vectorizer, TokenStore, TOKENIZERS
+from main import load_data, load_model
+
+# Parity and speed of the Vectorizer tokenizers (main.py --tokenizer) against the full spaCy pipeline, on reviews of a
+# prepare_data.py pickle. Word ids come from a saved model (--model) or a dictionnary built with the full pipeline.
+# Per tokenizer: reviews/sec, share of reviews vectorized exactly as the reference, of reviews with as many sentences,
+# similarity of the word id sequences (difflib ratio over each review, all sentences concatenated) and token count ratio.
+
+
+def parity(ref,out):
+    same = same_sents = 0
+    matched = total = n_ref = n_out = 0
+
+    for r,o in zip(ref,out):
+        r = [s.tolist() for s in r]
+        o = [s.tolist() for s in o]
+        same += r == o
+        same_sents += len(r) == len(o)
+
+        flat_r = [w for s in r for w in s]
+        flat_o = [w for s in o for w in s]
+        matched += SequenceMatcher(None,flat_r,flat_o,autojunk=False).ratio() * (len(flat_r)+len(flat_o)) / 2.
+        total += (len(flat_r)+len(flat_o)) / 2.
+        n_ref += len(flat_r)
+        n_out += len(flat_o)
+
+    n = float(len(ref))
+    return {"identical":same/n,"same_sentences":same_sents/n,"ids":matched/total,"tokens":n_out/float(n_ref)}
+
+
+def main(args):
+    tuples,_,_ = load_data(args.filename)
+    if isinstance(tuples,TokenStore):
+        raise ValueError("{} is a token store, reviews are already tokenized: use a pickle from prepare_data.py".format(args.filename))
+
+    rng = np.random.RandomState(args.seed)
+    picked = rng.choice(len(tuples),size=min(args.n,len(tuples)),replace=False)
+    texts = [tuples[i][2] for i in picked]
+
+    if args.model:
+        _,word_dict,_ = load_model(args.model)
+    else:
+        reference = Vectorizer(tokenizer="spacy")
+        reference.build_dict(texts,args.max_feat)
+        word_dict = reference.word_dict
+
+    ref = None
+    for name in args.tokenizers:
+        vectorizer = Vectorizer(word_dict,max_sent_len=args.max_sents,max_word_len=args.max_words,tokenizer=name,n_process=args.n_process)
+
+        start = time.perf_counter()
+        out = vectorizer.vectorize_batch(texts,trim=args.trim)
+        elapsed = time.perf_counter() - start
+
+        if ref is None:
+            ref = out
+        p = parity(ref,out)
+
+        print("{:12} {:10.1f} reviews/s  identical {:7.2%}  same sentences {:7.2%}  ids {:7.2%}  tokens x{:.3f}".format(
+              name,len(texts)/elapsed,p["identical"],p["same_sentences"],p["ids"],p["tokens"]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("filename", type=str, help="prepare_data.py pickle")
+    parser.add_argument("--model", type=str, help="model saved by main.py --save (word dictionnary)")
+    parser.add_argument("--tokenizers", choices=TOKENIZERS, nargs="+", default=list(TOKENIZERS), help="first one is the reference")
+    parser.add_argument("--n", type=int, default=2000, help="reviews compared")
+    parser.add_argument("--n-process", type=int, default=1)
+    parser.add_argument("--max-feat", type=int, default=10000)
+    parser.add_argument("--max-words", type=int, default=32)
+    parser.add_argument("--max-sents", type=int, default=16)
+    parser.add_argument("--trim", action="store_true", help="trim to --max-sents/--max-words as training does")
+    parser.add_argument("--seed", type=int, default=1337)
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,85 @@
+import json
+import time
+import random
+import asyncio
+import argparse
+
+import numpy as np
+
+# Load generator for server.py: `--concurrency` keep-alive clients send `--requests` reviews in total
+# (json lines from --input, or synthetic ones) and report throughput, client-side latencies and the server metrics.
+
+
+WORDS = "the a this was is great bad good not very movie product quality price love hate it and but works".split()
+
+
+def synthetic(n,rng):
+    for i in range(n):
+        text = " ".join(" ".join(rng.choice(WORDS) for _ in range(rng.randint(3,20)))+"." for _ in range(rng.randint(1,8)))
+        yield {"user":rng.randint(0,1000),"item":rng.randint(0,1000),"review":text}
+
+
+async def request(reader,writer,host,method,path,obj=None):
+    body = json.dumps(obj).encode("utf-8") if obj is not None else b""
+    writer.write("{} {} HTTP/1.1\r\nHost: {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n".format(method,path,host,len(body)).encode("latin-1")+body)
+    await writer.drain()
+
+    status = await reader.readline()
+    length = 0
+    while True:
+        h = await reader.readline()
+        if h in (b"\r\n",b"\n",b""):
+            break
+        k,v = h.decode("latin-1").split(":",1)
+        if k.strip().lower() == "content-length":
+            length = int(v)
+
+    return int(status.split()[1]),json.loads(await reader.readexactly(length))
+
+
+async def client(rows,args,latencies,errors):
+    reader,writer = await asyncio.open_connection(args.host,args.port)
+    while len(rows) > 0:
+        row = rows.pop()
+        start = time.time()
+        status,_ = await request(reader,writer,args.host,"POST","/predict",row)
+        latencies.append(time.time()-start)
+        if status != 200:
+            errors.append(status)
+    writer.close()
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+    if args.input:
+        with open(args.input) as f:
+            rows = [json.loads(l) for l in f if len(l.strip()) > 0][:args.requests]
+    else:
+        rows = list(synthetic(args.requests,rng))
+
+    latencies,errors = [],[]
+    start = time.time()
+    await asyncio.gather(*(client(rows,args,latencies,errors) for _ in range(args.concurrency)))
+    elapsed = time.time() - start
+
+    reader,writer = await asyncio.open_connection(args.host,args.port)
+    _,metrics = await request(reader,writer,args.host,"GET","/metrics")
+    writer.close()
+
+    lat = np.array(latencies) * 1000
+    print("{} requests, {} clients: {:.1f} requests/sec, {} errors".format(len(latencies),args.concurrency,len(latencies)/elapsed,len(errors)))
+    print("client latency: p50 {:.1f}ms p99 {:.1f}ms".format(np.percentile(lat,50),np.percentile(lat,99)))
+    print("server metrics: {}".format(json.dumps(metrics)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--input", type=str, help="json lines reviews (default: synthetic)")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--seed", type=int, default=1337)
+    args = parser.parse_args()
+
+    asyncio.run(run(args))
@@ -0,0 +1,201 @@
+import os
+import sys
+import json
+import shutil
+import argparse
+import platform
+import tempfile
+import timeit
+
+import numpy as np
+import torch
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),".."))
+from Nets import HierarchicalDoc
+from Data import TuplesListDataset, Vectorizer, TOKENIZERS
+from main import tuple_batcher_builder, load_embeddings, convert_embeddings
+
+# Benchmark suite of the data and model hot paths, on a synthetic corpus (no download needed):
+#   build_train_test   TuplesListDataset.build_train_test            --sizes reviews
+#   vectorize          Vectorizer.vectorize_batch (--tokenizer)      --sizes reviews
+#   collate            main.tuple_batcher_builder collate function   --b-sizes reviews per batch
+#   forward            HierarchicalDoc forward (training mode)       --b-sizes
+#   backward           forward + backward                            --b-sizes
+#   load_embeddings    main.load_embeddings, text and .npy files     --emb-words words
+# Only vectorize tokenizes (it is skipped if the --tokenizer can't be loaded, e.g. no spaCy model): the other benchmarks
+# use the synthetic words directly, no download is needed.
+# Results (best of --repeat, seconds per call) go to a json file:
+#   python benchmarks/suite.py --output base.json
+# and two result files are compared, with a non-zero exit status if a benchmark got slower by more than --threshold:
+#   python benchmarks/suite.py --compare base.json new.json
+
+
+def synthetic_corpus(n,args,rng):
+    """
+    n (user, item, text, rating) tuples. Words are "w<rank>" drawn from a Zipf law over --vocab words, reviews have
+    geometric numbers of sentences (mean --sents-mean) and sentences Poisson numbers of words (mean --words-mean).
+    """
+    p = 1. / np.arange(1,args.vocab+1) ** args.zipf
+    p /= p.sum()
+
+    tuples = []
+    for _ in range(n):
+        sents = []
+        for _ in range(rng.geometric(1./args.sents_mean)):
+            words = rng.choice(args.vocab,size=rng.poisson(args.words_mean-1)+1,p=p)
+            sents.append(" ".join("w{}".format(w) for w in words) + ".")
+        tuples.append((rng.randint(0,args.users),rng.randint(0,args.items),"  ".join(sents),rng.randint(1,6)))
+
+    return tuples
+
+
+def synthetic_reviews(corpus,word_dict,args):
+    """
+    Reviews of the synthetic corpus as vectorized and trimmed by Vectorizer, without tokenizing: words are space separated
+    """
+    revs = []
+    for _,_,text,_ in corpus:
+        sents = [s.rstrip(".").split()[:args.max_words] for s in text.split("  ")[:args.max_sents]]
+        revs.append([torch.LongTensor([word_dict[w] for w in s]) for s in sents])
+    return revs
+
+
+def timed(fn,args,number=1):
+    fn()
+    return min(timeit.repeat(fn,number=number,repeat=args.repeat)) / number
+
+
+def run(args):
+    rng = np.random.RandomState(args.seed)
+    torch.manual_seed(args.seed)
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    results = {}
+
+    def record(name,size,seconds):
+        results["{}[{}]".format(name,size)] = {"name":name,"size":size,"seconds":seconds}
+        print("{:>20} {:>8} : {:10.3f} ms".format(name,size,seconds*1e3))
+
+    corpus = synthetic_corpus(max(args.sizes + [args.vectorize_max]),args,rng)
+    splits = rng.randint(0,5,size=len(corpus)).tolist()
+
+    word_dict = {"w{}".format(w):w+2 for w in range(args.vocab)} # the synthetic vocabulary, no tokenizing needed
+    word_dict.update({"_padding_":0,"_unk_word_":1})
+    vectorizer = Vectorizer(word_dict,max_sent_len=args.max_sents,max_word_len=args.max_words,tokenizer=args.tokenizer)
+
+    for n in args.sizes:
+        record("build_train_test",n,timed(lambda: TuplesListDataset.build_train_test(corpus[:n],splits[:n],0,validation=n//10),args))
+    for n in args.sizes:
+        if n <= args.vectorize_max:
+            try:
+                record("vectorize",n,timed(lambda: vectorizer.vectorize_batch([t[2] for t in corpus[:n]],trim=True),args))
+            except (ImportError,OSError) as e: # spaCy or its English model not installed
+                print("{:>20} {:>8} : skipped, {} tokenizer unavailable ({})".format("vectorize",n,args.tokenizer,e))
+                break
+
+    revs = synthetic_reviews(corpus[:max(args.b_sizes)],word_dict,args)
+    tuples = [(u,i,r,rating-1) for (u,i,_,rating),r in zip(corpus,revs)]
+    tuple_batch = tuple_batcher_builder()
+    net = HierarchicalDoc(len(vectorizer.word_dict),args.users,args.items,5,emb_size=args.emb_size,hid_size=args.hid_size)
+    criterion = torch.nn.CrossEntropyLoss()
+
+    for b in args.b_sizes:
+        batch = tuples[:b]
+        record("collate",b,timed(lambda: tuple_batch(batch),args,args.number))
+
+        batch_t,r_t,u_t,i_t,stat,_ = tuple_batch(batch)
+        record("forward",b,timed(lambda: net(batch_t,u_t,i_t,stat),args,args.number))
+
+        def backward():
+            net.zero_grad()
+            criterion(net(batch_t,u_t,i_t,stat),r_t).backward()
+        record("backward",b,timed(backward,args,args.number))
+
+    tmp = tempfile.mkdtemp()
+    try:
+        for n in args.emb_words:
+            path = os.path.join(tmp,"emb{}.txt".format(n))
+            with open(path,"w") as f:
+                f.write("{} {}\n".format(n,args.emb_size))
+                for w in range(n):
+                    f.write("w{} {}\n".format(w," ".join("{:.5f}".format(x) for x in rng.randn(args.emb_size))))
+            convert_embeddings(path,path[:-len(".txt")])
+
+            record("load_embeddings_txt",n,timed(lambda: load_embeddings(path),args))
+            record("load_embeddings_npy",n,timed(lambda: load_embeddings(path[:-len(".txt")]+".npy"),args))
+    finally:
+        shutil.rmtree(tmp)
+
+    return {"meta":{"python":platform.python_version(),"torch":torch.__version__,"numpy":np.__version__,"machine":platform.machine(),
+                    "processor":platform.processor(),"threads":torch.get_num_threads(),"args":vars(args)},
+            "results":results}
+
+
+def compare(base,new,threshold):
+    """
+    Prints the time ratio (new / base) of the benchmarks in both files, returns the names of those slower by more than threshold
+    """
+    regressions = []
+    for key,b in base["results"].items():
+        if key not in new["results"]:
+            continue
+        ratio = new["results"][key]["seconds"] / b["seconds"]
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "REGRESSION"
+            regressions.append(key)
+        elif ratio < 1 - threshold:
+            flag = "faster"
+        print("{:>30} : {:10.3f} ms -> {:10.3f} ms  x{:5.2f}  {}".format(key,b["seconds"]*1e3,new["results"][key]["seconds"]*1e3,ratio,flag))
+
+    for key in sorted(set(base["results"]) ^ set(new["results"])):
+        print("{:>30} : only in {}".format(key,"base" if key in base["results"] else "new"))
+
+    return regressions
+
+
+def main(args):
+    if args.compare:
+        files = []
+        for path in args.compare:
+            with open(path) as f:
+                files.append(json.load(f))
+        regressions = compare(files[0],files[1],args.threshold)
+        print("{} regression(s) over {:.0%}".format(len(regressions),args.threshold))
+        sys.exit(1 if len(regressions) > 0 else 0)
+
+    res = run(args)
+    if args.output:
+        with open(args.output,"w") as f:
+            json.dump(res,f,indent=1)
+        print("-> results saved to {}".format(args.output))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks of the data and model hot paths on a synthetic corpus')
+    parser.add_argument("--output", type=str, help="json results file")
+    parser.add_argument("--compare", type=str, nargs=2, metavar=("BASE","NEW"), help="compare two results files instead of running")
+    parser.add_argument("--threshold", type=float, default=0.1, help="slowdown flagged as a regression (0.1: 10%%)")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000,10000], help="corpus sizes (reviews)")
+    parser.add_argument("--vectorize-max", type=int, default=1000, help="largest corpus size vectorized (spaCy is slow)")
+    parser.add_argument("--tokenizer", choices=TOKENIZERS, default="spacy", help="tokenizer of the vectorize benchmark")
+    parser.add_argument("--b-sizes", type=int, nargs="+", default=[16,64], help="batch sizes (reviews)")
+    parser.add_argument("--emb-words", type=int, nargs="+", default=[10000,50000], help="embedding file sizes (words)")
+    parser.add_argument("--vocab", type=int, default=20000)
+    parser.add_argument("--zipf", type=float, default=1.1, help="Zipf exponent of word frequencies")
+    parser.add_argument("--sents-mean", type=float, default=8)
+    parser.add_argument("--words-mean", type=float, default=15)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--items", type=int, default=1000)
+    parser.add_argument("--max-sents", type=int, default=16)
+    parser.add_argument("--max-words", type=int, default=32)
+    parser.add_argument("--emb-size", type=int, default=200)
+    parser.add_argument("--hid-size", type=int, default=50)
+    parser.add_argument("--number", type=int, default=5, help="calls per timing of the batch benchmarks")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--threads", type=int, help="torch cpu threads")
+    parser.add_argument("--seed", type=int, default=1337)
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,15 @@
+import argparse
+
+from main import convert_embeddings
+
+# Converts word2vec text embeddings to a binary .npy matrix + .vocab.json word list,
+# which main.py --emb loads through a memory map.
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input", type=str, help="word2vec text file")
+    parser.add_argument("output", type=str, help="output prefix (writes output.npy and output.vocab.json)")
+    args = parser.parse_args()
+
+    convert_embeddings(args.input,args.output)
@@ -0,0 +1,78 @@
+import argparse
+
+import numpy as np
+import torch
+
+from main import load_model, pad_batch, tensor_batch
+
+# Exports a model saved by main.py --save to TorchScript and/or ONNX through its tensor only forward (Nets.ExportableDoc).
+# Inputs: tokens (n_sents x max_len), sent_lens (n_sents), sent_review (n_sents), users and items (n_reviews), see main.tensor_batch.
+# Output: logits (n_reviews x n_class). All dimensions are dynamic: the module is scripted, not traced.
+# Outputs are checked against the eager model on random batches of varying sizes (ONNX ones with onnxruntime, if installed).
+
+INPUTS = ["tokens","sent_lens","sent_review","users","items"]
+
+
+def random_batches(net,n,max_reviews,max_sents,max_words,seed):
+    rng = np.random.RandomState(seed)
+    for _ in range(n):
+        n_revs = rng.randint(1,max_reviews+1)
+        revs = [[torch.from_numpy(rng.randint(2,net.embed.num_embeddings,size=rng.randint(1,max_words+1))) for _ in range(rng.randint(1,max_sents+1))] for _ in range(n_revs)]
+        users = torch.from_numpy(rng.randint(0,net.users.num_embeddings,size=n_revs))
+        items = torch.from_numpy(rng.randint(0,net.items.num_embeddings,size=n_revs))
+        yield revs,users,items
+
+
+def main(args):
+    net,_,_ = load_model(args.model,"fp32")
+    net.eval()
+    scripted = torch.jit.script(net.exportable().eval())
+    example = next(random_batches(net,1,4,4,8,args.seed))
+
+    if args.torchscript:
+        torch.jit.save(scripted,args.torchscript)
+        print("-> TorchScript model saved to {}".format(args.torchscript))
+
+    session = None
+    if args.onnx:
+        dims = {"tokens":{0:"sents",1:"max_len"},"sent_lens":{0:"sents"},"sent_review":{0:"sents"},"users":{0:"reviews"},"items":{0:"reviews"},"logits":{0:"reviews"}}
+        torch.onnx.export(scripted,tensor_batch(example[0])+example[1:],args.onnx,input_names=INPUTS,output_names=["logits"],
+                          dynamic_axes=dims,opset_version=args.opset,dynamo=False)
+        print("-> ONNX model saved to {}".format(args.onnx))
+
+        try:
+            import onnxruntime
+            session = onnxruntime.InferenceSession(args.onnx)
+        except ImportError:
+            print("onnxruntime is not installed, ONNX outputs are not checked")
+
+    errors = {"torchscript":0.,"onnx":0.}
+    with torch.no_grad():
+        for revs,users,items in random_batches(net,args.check,args.max_reviews,args.max_sents,args.max_words,args.seed+1):
+            batch_t,stat = pad_batch(revs)
+            ref = net(batch_t,users,items,stat)
+            inputs = tensor_batch(revs) + (users,items)
+
+            errors["torchscript"] = max(errors["torchscript"],float((scripted(*inputs)-ref).abs().max()))
+            if session is not None:
+                out = session.run(None,{k:v.numpy() for k,v in zip(INPUTS,inputs)})[0]
+                errors["onnx"] = max(errors["onnx"],float(np.abs(out-ref.numpy()).max()))
+
+    print("Max abs difference with the eager model over {} batches: TorchScript {:.2e}{}".format(
+          args.check,errors["torchscript"],", ONNX {:.2e}".format(errors["onnx"]) if session is not None else ""))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='TorchScript / ONNX export of a saved Hierarchical Attention Network')
+    parser.add_argument("model", type=str, help="model saved by main.py --save")
+    parser.add_argument("--torchscript", type=str, help="TorchScript output path (.pt)")
+    parser.add_argument("--onnx", type=str, help="ONNX output path (.onnx)")
+    parser.add_argument("--opset", type=int, default=17)
+    parser.add_argument("--check", type=int, default=20, help="random batches compared with the eager model")
+    parser.add_argument("--max-reviews", type=int, default=64)
+    parser.add_argument("--max-words", type=int,default=32)
+    parser.add_argument("--max-sents",type=int,default=16)
+    parser.add_argument("--seed", type=int, default=1337)
+    args = parser.parse_args()
+
+    main(args)
@@ -1,4 +1,11 @@
+import os
+import sys
+import glob
+import json
+import random
+import threading
 import argparse
+from contextlib import nullcontext
 import pickle as pkl
 import numpy as np
 from tqdm import tqdm
@@ -8,18 +15,98 @@ import torch.nn as nn
 import torch.optim as optim
 from torch.autograd import Variable
 from torch.utils.data import DataLoader
-from torch.utils.data.sampler import Sampler
+from torch.utils.data.distributed import DistributedSampler
+from torch.utils.data.sampler import Sampler, BatchSampler
 
+import Distributed
+from Profiling import Profiler
 from Nets import HierarchicalDoc
-from Data import TuplesListDataset, Vectorizer, BucketSampler
+from Data import TuplesListDataset, HashedMapping, Vectorizer, TOKENIZERS, BucketSampler, LengthBucketSampler, TokenBudgetSampler, SkipBatches, TokenStore, ragged_index
+
+
+PRECISIONS = ("fp32","bf16","int8")
+
+
+def cpu_snapshot(obj):
+    """
+    Copy of a (nested dict/list/tuple) state where tensors are detached cpu copies: training can go on while it is written.
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu",copy=True)
+    if isinstance(obj,dict):
+        return type(obj)((k,cpu_snapshot(v)) for k,v in obj.items())
+    if isinstance(obj,(list,tuple)):
+        return type(obj)(cpu_snapshot(v) for v in obj)
+    return obj
+
+
+class Checkpointer(object):
+    """
+    Writes resumable training states to {prefix}.{epoch}.{iteration}.ckpt from a background thread (one write at a time),
+    through a temporary file renamed once complete, and keeps the last keep checkpoints.
+    """
+
+    def __init__(self,prefix,keep=3):
+        self.prefix = prefix
+        self.keep = keep
+        self.thread = None
+
+    def save(self,state,epoch,iteration):
+        state = cpu_snapshot(state) # taken before returning, the write overlaps with training
+        self.wait()
+
+        path = "{}.{:04d}.{:08d}.ckpt".format(self.prefix,epoch,iteration)
+        self.thread = threading.Thread(target=self._write,args=(state,path))
+        self.thread.start()
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _write(self,state,path):
+        tmp = "{}.tmp{}".format(path,os.getpid())
+        torch.save(state,tmp)
+        os.replace(tmp,path)
+
+        for old in Checkpointer.saved(self.prefix)[:-self.keep]:
+            os.remove(old)
+
+    @staticmethod
+    def saved(prefix):
+        """
+        Checkpoint paths of prefix, oldest first
+        """
+        return sorted(glob.glob(glob.escape(prefix) + ".[0-9]*.[0-9]*.ckpt"))
+
+    @staticmethod
+    def latest(prefix):
+        saved = Checkpointer.saved(prefix)
+        return saved[-1] if len(saved) > 0 else None
+
+
+def rng_states(cuda=False,samplers=True):
+    """
+    Global random states. Without samplers, only the torch ones (dropout) and not those drawn by samplers (numpy, python).
+    """
+    states = {"torch":torch.get_rng_state()}
+    if samplers:
+        states.update({"numpy":np.random.get_state(),"python":random.getstate()})
+    if cuda:
+        states["cuda"] = torch.cuda.get_rng_state_all()
+    return states
+
+
+def set_rng_states(states):
+    torch.set_rng_state(states["torch"])
+    if "numpy" in states:
+        np.random.set_state(states["numpy"])
+    if "python" in states:
+        random.setstate(states["python"])
+    if "cuda" in states and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(states["cuda"])
 
 
-
-def checkpoint(epoch,net,output):
-    model_out_path = output+"_epoch_{}.pth".format(epoch)
-    torch.save(net, model_out_path)
-    print("Checkpoint saved to {}".format(model_out_path))
-
 def check_memory(emb_size,max_sents,max_words,b_size,cuda):
     try:
         e_size = (2,b_size,max_sents,max_words,emb_size) 
@@ -40,70 +127,244 @@ def check_memory(emb_size,max_sents,max_words,b_size,cuda):
         sys.exit()
 
 
-def load_embeddings(file):
-    emb_file = open(file).readlines()
-    first = emb_file[0]
-    word, vec = int(first.split()[0]),int(first.split()[1])
-    size = (word,vec)
-    print("--> Got {} words of {} dimensions".format(size[0],size[1]))
-    tensor = np.zeros((size[0]+2,size[1]),dtype=np.float32) ## adding padding + unknown
-    word_d = {}
-    word_d["_padding_"] = 0
-    word_d["_unk_word_"] = 1
+def _load_text_embeddings(file,restrict=None,out=None):
+    """
+    Parses a word2vec text file. Row i holds the word on line i (header is line 1), rows 0 and 1 are padding and unknown word.
+    With restrict, only lines of words in restrict are parsed and rows are packed. With out, the tensor is written to out (.npy).
+    """
+    with open(file) as emb_file:
+        first = emb_file.readline()
+        size = (int(first.split()[0]),int(first.split()[1]))
+        print("--> Got {} words of {} dimensions".format(size[0],size[1]))
+
+        word_d = {}
+        word_d["_padding_"] = 0
+        word_d["_unk_word_"] = 1
+
+        if restrict is not None:
+            rows = [np.zeros(size[1],dtype=np.float32),np.zeros(size[1],dtype=np.float32)]
+        elif out is not None:
+            tensor = np.lib.format.open_memmap(out,mode="w+",dtype=np.float32,shape=(size[0]+2,size[1]))
+            tensor[:2] = 0
+        else:
+            tensor = np.zeros((size[0]+2,size[1]),dtype=np.float32) ## adding padding + unknown
+
+        for i,line in tqdm(enumerate(emb_file,2),desc="Creating embedding tensor",total=size[0]):
+            spl = line.strip().split(" ")
+
+            if len(spl[1:]) != size[1]: #word is most probably whitespace or junk if badly parsed
+                print("WARNING: MALFORMED EMBEDDING DICTIONNARY:\n {} \n line isn't parsed correctly".format(line))
+            elif restrict is not None:
+                if spl[0] in restrict:
+                    word_d[spl[0]] = len(rows)
+                    rows.append(np.array(spl[1:],dtype=np.float32))
+            else:
+                word_d[spl[0]] = i
+                tensor[i] = np.array(spl[1:],dtype=np.float32)
+
+    if restrict is not None:
+        tensor = np.stack(rows)
+    elif len(word_d) != size[0]+2:
+        print("Final dictionnary length differs from number of embeddings - some lines were malformed.")
+
+    return tensor, word_d
+
+
+def convert_embeddings(file,out):
+    """
+    Converts a word2vec text file to out.npy (float32 matrix, loaded memory mapped) and out.vocab.json (word of each row)
+    """
+    tensor,word_d = _load_text_embeddings(file,out=out+".npy")
+    tensor.flush()
+
+    vocab = [None] * len(tensor)
+    for w,i in word_d.items():
+        vocab[i] = w
+
+    with open(out+".vocab.json","w") as f:
+        json.dump(vocab,f)
+
+
+def load_embeddings(file,restrict=None):
+    """
+    Loads embeddings from a word2vec text file or a .npy file made by convert_emb.py.
+    With restrict (set of words), only the rows of those words are kept and the dictionnary is re-indexed.
+    """
+    if not file.endswith(".npy"):
+        tensor,word_d = _load_text_embeddings(file,restrict)
+    else:
+        tensor = np.load(file,mmap_mode="r")
+        with open(file[:-len(".npy")]+".vocab.json") as f:
+            vocab = json.load(f)
+        print("--> Got {} words of {} dimensions".format(len(tensor)-2,tensor.shape[1]))
+
+        word_d = {w:i for i,w in enumerate(vocab) if w is not None and (restrict is None or i < 2 or w in restrict)}
+        rows = sorted(word_d.values())
+        tensor = np.array(tensor[rows],dtype=np.float32)
+        word_d = {vocab[r]:i for i,r in enumerate(rows)}
+
+    if restrict is not None:
+        print("--> Kept {} words found in training data".format(len(word_d)-2))
 
     print("--> Shape with padding and unk_token:")
     print(tensor.shape)
 
-    for i,line in tqdm(enumerate(emb_file,1),desc="Creating embedding tensor",total=len(emb_file)):
-        if i==1: #skipping header (-1 to the enumeration to take it into account)
-            continue
+    return tensor, word_d
 
-        spl = line.strip().split(" ")
+def load_data(filename):
+    """
+    Returns (tuples, splits, raw user/item ids) of a prepare_data.py output: pickle file or --store directory
+    """
+    if os.path.isdir(filename): # columnar store from prepare_data.py --store
+        tuples = TokenStore(filename)
+        splits = tuples.splits
+        raw_ids = {f:{k:i for i,k in enumerate(json.load(open(os.path.join(filename,f+".json"))))} for f in ("users","items")}
+    else:
+        datadict = pkl.load(open(filename,"rb"))
+        tuples = datadict["data"]
+        splits  = datadict["splits"]
+        raw_ids = {f:datadict[f] for f in ("users","items") if f in datadict}
 
-        if len(spl[1:]) == size[1]: #word is most probably whitespace or junk if badly parsed
-            word_d[spl[0]] = i
-            tensor[i] = np.array(spl[1:],dtype=np.float32)
-        else:
-            print("WARNING: MALFORMED EMBEDDING DICTIONNARY:\n {} \n line isn't parsed correctly".format(line))
+    return tuples,splits,raw_ids
 
-    try:
-        assert(len(word_d)==size[0]+2)
-    except:
-        print("Final dictionnary length differs from number of embeddings - some lines were malformed.")
 
-    return tensor, word_d
+def set_precision(net,precision):
+    """
+    Inference precision of a network: int8 quantizes the GRU and Linear weights (dynamic quantization, activations
+    are quantized on the fly), bf16 runs them in bfloat16 (autocast, see score.Scorer). Embeddings stay in float32.
+    """
+    if precision not in PRECISIONS:
+        raise ValueError("Unknown precision {}, expected one of {}".format(precision,PRECISIONS))
+
+    if precision == "int8":
+        net = torch.ao.quantization.quantize_dynamic(net,{nn.GRU,nn.Linear},dtype=torch.qint8)
+    net.precision = precision
 
-def save(net,dic,path):
+    return net
+
+
+def save(net,dic,path,mappings=None,precision=None,tokenizer=None):
+    """
+    Saves model weights with the word dictionnary and, optionally, the user/item/class mappings used to train it,
+    the precision it should run with (weights are always saved in float32, see set_precision)
+    and the tokenizer its word dictionnary was built with (see Data.get_tokenizer).
+    """
     dict_m = net.state_dict()
     dict_m["word_dic"] = dic
     dict_m["reviews"] = torch.Tensor()
     dict_m["word.mask"] = torch.Tensor()
     dict_m["sent.mask"] = torch.Tensor()
 
+    if mappings is not None:
+        dict_m["mappings"] = plain_mappings(mappings)
+    if precision is not None:
+        dict_m["precision"] = precision
+    if tokenizer is not None:
+        dict_m["tokenizer"] = tokenizer
+
     torch.save(dict_m,path)
 
 
-def tuple_batcher_builder(vectorizer, trim=True):
+def plain_mappings(mappings):
+    """
+    Mappings as plain dicts (saved files do not depend on Data.py classes), hashing parameters are in mappings["hashing"]
+    """
+    return {k:(dict(m) if isinstance(m,HashedMapping) else m) for k,m in mappings.items()}
+
+
+def restore_mappings(mappings):
+    """
+    Inverse of plain_mappings
+    """
+    for field,hashing in mappings.get("hashing",{}).items():
+        mappings[field] = HashedMapping(mappings[field],**hashing)
+    return mappings
+
+
+def load_model(path,precision=None):
+    """
+    Inverse of save: returns the network (on cpu), its word dictionnary and mappings (None for older saves).
+    The network runs with the saved precision (float32 for older saves) unless precision is given,
+    net.tokenizer is the tokenizer to vectorize its inputs with.
+    """
+    state = torch.load(path,map_location="cpu")
+    word_dic = state.pop("word_dic")
+    mappings = state.pop("mappings",None)
+    saved_precision = state.pop("precision","fp32")
+    tokenizer = state.pop("tokenizer","spacy")
+
+    if mappings is not None:
+        mappings = restore_mappings(mappings)
+
+    net = HierarchicalDoc(ntoken=len(word_dic), nusers=state["users.weight"].size(0), nitems=state["items.weight"].size(0), emb_size=state["embed.weight"].size(1),hid_size=state["sent.gru.weight_hh_l0"].size(1),num_class=state["lin_out.weight"].size(0))
+    net.load_state_dict(state)
+
+    net = set_precision(net,precision or saved_precision)
+    net.tokenizer = tokenizer
+
+    return net,word_dic,mappings
+
+
+def pad_batch(list_rev):
+    """
+    Pads the sentences of a list of vectorized reviews in a (n_sents x max_len) LongTensor.
+    Sentences are sorted by (sentence length, review length, review #, sentence #) decreasing, stat holds those 4 fields per row.
+    """
+    sents = [s for r in list_rev for s in r]
+    r_lens = np.array([len(r) for r in list_rev],dtype=np.int64)
+    s_lens = np.array([len(s) for s in sents],dtype=np.int64)
+
+    lr = np.repeat(r_lens,r_lens)
+    rn = np.repeat(np.arange(len(list_rev)),r_lens)
+    sn = ragged_index(np.zeros_like(r_lens),r_lens)
+
+    order = np.lexsort((sn,rn,lr,s_lens))[::-1]
+    lens = s_lens[order]
+    starts = np.cumsum(s_lens) - s_lens
+
+    words = torch.cat(sents)[torch.from_numpy(ragged_index(starts[order],lens))]
+    rows = torch.from_numpy(np.repeat(np.arange(len(order)),lens))
+    cols = torch.from_numpy(ragged_index(np.zeros_like(lens),lens))
+
+    batch_t = torch.zeros(len(order),int(lens[0])).long()
+    batch_t[rows,cols] = words
+
+    stat = list(zip(lens.tolist(),lr[order].tolist(),rn[order].tolist(),sn[order].tolist()))
+
+    return batch_t,stat
+
+
+def tensor_batch(list_rev):
+    """
+    Inputs of ExportableDoc for a list of vectorized reviews: (n_sents x max_len) padded sentences in review order,
+    sentence lengths and review # of each sentence.
+    """
+    sents = [s for r in list_rev for s in r]
+    sent_lens = torch.LongTensor([len(s) for s in sents])
+    sent_review = torch.repeat_interleave(torch.arange(len(list_rev)),torch.LongTensor([len(r) for r in list_rev]))
+    tokens = torch.nn.utils.rnn.pad_sequence(sents,batch_first=True)
+
+    return tokens,sent_lens,sent_review
+
+
+def tuple_batcher_builder(vectorizer=None, trim=True):
+    """
+    Collate function builder. Without vectorizer, reviews are expected to be already vectorized (see Vectorizer.vectorize_cached).
+    """
 
     def tuple_batch(l):
         user,item,review,rating = zip(*l)
         r_t = torch.Tensor(rating).long()
         u_t = torch.Tensor(user).long()
         i_t = torch.Tensor(item).long()
-        list_rev = vectorizer.vectorize_batch(review,trim)
 
-        # sorting by sentence-review length
-        stat =  sorted([(len(s),len(r),r_n,s_n,s) for r_n,r in enumerate(list_rev) for s_n,s in enumerate(r)],reverse=True)
+        if vectorizer is None:
+            list_rev = review
+        else:
+            list_rev = vectorizer.vectorize_batch(review,trim)
 
-        max_len = stat[0][0]
-        batch_t = torch.zeros(len(stat),max_len).long()
+        batch_t,stat = pad_batch(list_rev)
 
-        for i,s in enumerate(stat):
-            for j,w in enumerate(s[-1]): # s[-1] is sentence in stat tuple
-                batch_t[i,j] = w
-                
-        stat = [(ls,lr,r_n,s_n) for ls,lr,r_n,s_n,_ in stat]
-        
         return batch_t,r_t,u_t,i_t,stat,review
 
     return tuple_batch
@@ -128,106 +389,282 @@ def new_tensors(n,cuda,types={}):
 
     return tuple([new_tensor(types.setdefault(i,None),cuda) for i in range(0,n)])
 
-def train(epoch,net,optimizer,dataset,criterion,cuda):
-    epoch_loss = 0
-    ok_all = 0
-    data_tensors = new_tensors(4,cuda,types={0:torch.LongTensor,1:torch.LongTensor,2:torch.LongTensor,3:torch.LongTensor}) #data-tensors
+class SplitOptimizer(object):
+    """
+    Adam on dense parameters, SparseAdam on sparse embedding tables: a step only reads and updates the rows of the batch.
+    """
+
+    def __init__(self,net,**kwargs):
+        sparse = [m.weight for m in net.modules() if isinstance(m,nn.Embedding) and m.sparse]
+        dense = [p for p in net.parameters() if all(p is not t for t in sparse)]
+
+        self.optimizers = [optim.Adam(dense,**kwargs)]
+        if len(sparse) > 0:
+            self.optimizers.append(optim.SparseAdam(sparse,**kwargs))
+
+    @property
+    def param_groups(self):
+        return [g for o in self.optimizers for g in o.param_groups]
+
+    def zero_grad(self):
+        for o in self.optimizers:
+            o.zero_grad()
+
+    def step(self):
+        for o in self.optimizers:
+            o.step()
+
+    def state_dict(self):
+        return [o.state_dict() for o in self.optimizers]
+
+    def load_state_dict(self,states):
+        for o,state in zip(self.optimizers,states):
+            o.load_state_dict(state)
+
 
-    with tqdm(total=len(dataset),desc="Training") as pbar:
-        for iteration, (batch_t,r_t, u_t, i_t,stat,rev) in enumerate(dataset):
+def train(epoch,net,optimizer,dataset,criterion,cuda,distributed=False,start=0,totals=(0,0,0),rng=None,on_step=None,profiler=None):
+    """
+    One epoch over dataset. When resuming an epoch, dataset skips the start batches already done, totals are
+    their (loss sum, correct, seen) and rng the random states to continue with.
+    on_step(iteration,totals) is called after each optimizer step (see Checkpointer).
+    With a profiler (see Profiling.py), dataset batches come from its collate wrapper and each step is timed by stage.
+    """
+    epoch_loss,ok_all,seen = totals
+    data_tensors = new_tensors(4,cuda,types={0:torch.LongTensor,1:torch.LongTensor,2:torch.LongTensor,3:torch.LongTensor}) #data-tensors
+    stage = profiler.stage if profiler is not None else (lambda name: nullcontext())
+    hooks = profiler.attach(net) if profiler is not None else []
+
+    with tqdm(total=start+len(dataset),initial=start,desc="Training",disable=not Distributed.is_master()) as pbar:
+        batches = iter(dataset)
+        if rng is not None: # after iter(): the loader draws its seeds from the epoch start states
+            set_rng_states(rng)
+        if profiler is not None:
+            batches = profiler.iterate(batches)
+
+        iteration = start
+        for iteration, (batch_t,r_t, u_t, i_t,stat,rev) in enumerate(batches,start+1):
             
-            data = tuple2var(data_tensors,(batch_t,r_t,u_t,i_t))
+            with stage("h2d"):
+                data = tuple2var(data_tensors,(batch_t,r_t,u_t,i_t))
             optimizer.zero_grad()
             out = net(data[0],data[2],data[3],stat)
-            ok,per = accuracy(out,data[1])
-            loss = criterion(out, data[1])
-            epoch_loss += loss.data[0]
-            loss.backward()
+            with stage("loss"):
+                ok,per = accuracy(out,data[1])
+                loss = criterion(out, data[1])
+                epoch_loss += loss.item() * r_t.size(0) # batches have variable sizes: averages are per review
+            with stage("backward"):
+                loss.backward()
+
+                if distributed:
+                    Distributed.all_reduce_gradients(net,(net.embed,net.users,net.items))
 
-            optimizer.step()
+            with stage("optimizer"):
+                optimizer.step()
 
-            ok_all += per.data[0]
+            ok_all += ok.item()
+            seen += r_t.size(0)
+
+            if on_step is not None:
+                with stage("checkpoint"):
+                    on_step(iteration,(epoch_loss,ok_all,seen))
+
+            if profiler is not None:
+                profiler.step(epoch,iteration,batch_t,stat)
 
             pbar.update(1)
-            pbar.set_postfix({"acc":ok_all/(iteration+1),"CE":epoch_loss/(iteration+1)})
+            pbar.set_postfix({"acc":ok_all/seen*100,"CE":epoch_loss/seen})
+
+    for h in hooks:
+        h.remove()
+    if profiler is not None:
+        profiler.emit(epoch,iteration) # last steps of the epoch
+
+    if distributed:
+        epoch_loss,ok_all,seen = Distributed.all_reduce_sum(epoch_loss,ok_all,seen)
 
-    print("===> Epoch {} Complete: Avg. Loss: {:.4f}, {}% accuracy".format(epoch, epoch_loss /len(dataset),ok_all/len(dataset)))
+    print("===> Epoch {} Complete: Avg. Loss: {:.4f}, {}% accuracy".format(epoch, epoch_loss/seen,ok_all/seen*100))
 
 
 
-def test(epoch,net,dataset,cuda,msg="Evaluating"):
-    epoch_loss = 0
+def test(epoch,net,dataset,cuda,msg="Evaluating",distributed=False):
+    """
+    Accuracy of net on dataset, in eval mode (no dropout) without autograd. net is left in the mode it was in.
+    """
+    training = net.training
+    net.eval()
+
     ok_all = 0
-    pred = 0
+    seen = 0
     skipped = 0
     data_tensors = new_tensors(4,cuda,types={0:torch.LongTensor,1:torch.LongTensor,2:torch.LongTensor,3:torch.LongTensor}) #data-tensors
-    with tqdm(total=len(dataset),desc=msg) as pbar:
+    with torch.no_grad(), tqdm(total=len(dataset),desc=msg,disable=not Distributed.is_master()) as pbar:
         for iteration, (batch_t,r_t,u_t,i_t, stat,rev) in enumerate(dataset):
             data = tuple2var(data_tensors,(batch_t,r_t,u_t,i_t))
             out = net(data[0],data[2],data[3],stat)
 
             ok,per = accuracy(out,data[1])
-            ok_all += per.data[0]
-            pred+=1
+            ok_all += ok.item()
+            seen += r_t.size(0)
 
             pbar.update(1)
-            pbar.set_postfix({"acc":ok_all/pred, "skipped":skipped})
+            pbar.set_postfix({"acc":ok_all/seen*100, "skipped":skipped})
 
+    net.train(training)
 
-    print("===> {} Complete:  {}% accuracy".format(msg,ok_all/pred))
+    if distributed:
+        ok_all,seen = Distributed.all_reduce_sum(ok_all,seen)
 
-def accuracy(out,truth):
-    def sm(mat):
-        exp = torch.exp(mat)
-        sum_exp = exp.sum(1,True)+0.0001
-        return exp/sum_exp.expand_as(exp)
+    if seen == 0:
+        print("===> {} Complete:  no reviews".format(msg))
+        return None
 
-    _,max_i = torch.max(sm(out),1)
+    print("===> {} Complete:  {}% accuracy".format(msg,ok_all/seen*100))
+    return ok_all/seen*100
+
+def accuracy(out,truth):
+    _,max_i = torch.max(out,1) # softmax is monotonic, logits give the same argmax
 
     eq = torch.eq(max_i,truth).float()
     all_eq = torch.sum(eq)
 
     return all_eq, all_eq/truth.size(0)*100
 
-def main(args):
+def vectorize_sets(args,tuples,vectorizer,sets,rank=0,distributed=False):
+    """
+    Vectorizes the (name, dataset) sets with vectorizer, once: reviews are cached next to the data file (or in --cache-dir)
+    """
+    cache_dir = args.cache_dir if args.cache_dir else os.path.dirname(os.path.abspath(args.filename))
+    cache_prefix = os.path.join(cache_dir,"{}_split{}".format(os.path.basename(args.filename),args.split))
+
+    if distributed and rank != 0: # rank 0 fills the cache first, the others load it (if the file system is shared)
+        torch.distributed.barrier()
+
+    for name,dataset in sets:
+        if isinstance(tuples,TokenStore): # already vectorized, store ids are mapped at read time
+            dataset.tuplelist.set_word_dict(vectorizer.word_dict,args.max_sents,args.max_words)
+        else:
+            dataset.set_vectorized(2,vectorizer.vectorize_cached(dataset,2,"{}_{}".format(cache_prefix,name),trim=True))
+
+    if distributed and rank == 0:
+        torch.distributed.barrier()
+
+
+def eval_loader(args,dataset,collate,shard):
+    """
+    Evaluation DataLoader, sharded as well: every review is seen once over workers
+    """
+    if args.batch_tokens or args.batch_sents:
+        sampler = TokenBudgetSampler(dataset,args.batch_tokens,args.batch_sents,shuffle=False,**shard)
+        return DataLoader(dataset, batch_sampler=sampler, num_workers=2, collate_fn=collate)
+
+    return DataLoader(dataset, batch_size=args.b_size, sampler=range(shard["rank"],len(dataset),shard["world_size"]), num_workers=2, collate_fn=collate)
+
+
+def evaluate(args,tuples,test_set,rank=0,world_size=1):
+    """
+    --evaluate: test split accuracy of the --load model, without the training setup (train set mappings and vectorization,
+    class statistics, training loaders). The mappings and tokenizer saved with the model are used.
+    """
+    net,word_dict,mappings = load_model(args.load)
+    if mappings is None:
+        raise ValueError("{} has no user/item mappings, save it again with main.py --save".format(args.load))
+
+    test_set.set_mapping(3,mappings["classes"])
+    test_set.set_mapping(0,mappings["users"],unk=0)
+    test_set.set_mapping(1,mappings["items"],unk=0)
+
+    vectorizer = Vectorizer(word_dict,max_word_len=args.max_words,max_sent_len=args.max_sents,tokenizer=net.tokenizer,n_process=args.n_process)
+    vectorize_sets(args,tuples,vectorizer,(("test",test_set),),rank,world_size > 1)
+    dataloader_test = eval_loader(args,test_set,tuple_batcher_builder(),{"rank":rank,"world_size":world_size})
+
+    if args.cuda:
+        net.cuda()
+
+    test(0,net,dataloader_test,args.cuda,distributed=world_size > 1) # in eval mode, as during training
+
+
+def main(args,data=None,sets=None):
+    """
+    Trains on split args.split of data ((tuples, splits, raw ids) loaded from args.filename by default), returns the last test accuracy.
+    sets: (train, validation, test) datasets of that split, if already built.
+    """
+
+    rank,world_size = Distributed.init() if args.distributed else (0,1)
+    distributed = world_size > 1
+    if rank != 0: # rank 0 logs and saves
+        sys.stdout = open(os.devnull,"w")
 
     print(32*"-"+"\nHierarchical Attention Network:\n" + 32*"-")
     print("\nLoading Data:\n" + 25*"-")
 
     max_features = args.max_feat
-    datadict = pkl.load(open(args.filename,"rb"))
-    tuples = datadict["data"]
-    splits  = datadict["splits"]
-    split_keys = set(x for x in splits)
+    tuples,splits,raw_ids = data if data is not None else load_data(args.filename)
+
+    split_keys = set(np.unique(splits).tolist())
 
     if args.split not in split_keys:
         print("Chosen split (#{}) not in split set {}".format(args.split,split_keys))
     else:
         print("Split #{} chosen".format(args.split))
 
-    train_set,val_set,test_set = TuplesListDataset.build_train_test(tuples,splits,args.split,validation=500)
+    if sets is None:
+        validation = 0 if args.evaluate else args.validation # --evaluate only uses the test split
+        sets = TuplesListDataset.build_train_test(tuples,splits,args.split,validation=validation,seed=args.seed)
+    train_set,val_set,test_set = sets
 
     print("Train set length:",len(train_set))
+    print("Validation set length:",len(val_set) if val_set is not None else 0)
     print("Test set length:",len(test_set))
 
-    user_mapping = train_set.set_mapping(0,offset=1) #creates user mapping
-    item_mapping = train_set.set_mapping(1,offset=1) #creates item mapping
-    classes = train_set.set_mapping(3) #creates class mapping
+    if args.evaluate:
+        evaluate(args,tuples,test_set,rank,world_size)
+        if distributed:
+            torch.distributed.destroy_process_group()
+        return
+
+    resume = None
+    if args.resume:
+        path = Checkpointer.latest(args.checkpoint) if args.resume == "latest" and args.checkpoint else args.resume
+        if path is None or not os.path.exists(path):
+            raise ValueError("No checkpoint to resume from ({})".format(path or "--resume without a path needs --checkpoint"))
+
+        resume = torch.load(path,map_location="cpu",weights_only=False)
+        if len(resume["ranks"]) != world_size:
+            raise ValueError("{} was saved by {} workers, not {}".format(path,len(resume["ranks"]),world_size))
+        print("-> Resuming from {} (epoch {}, iteration {})".format(path,resume["epoch"],resume["iteration"]))
+
+    if resume is not None: # same mappings as the interrupted run
+        saved = restore_mappings(resume["mappings"])
+        user_mapping = train_set.set_mapping(0,saved["users"])
+        item_mapping = train_set.set_mapping(1,saved["items"])
+        classes = train_set.set_mapping(3,saved["classes"])
+    else:
+        user_mapping = train_set.set_mapping(0,offset=1,min_count=args.min_count,buckets=args.hash_buckets) #creates user mapping
+        item_mapping = train_set.set_mapping(1,offset=1,min_count=args.min_count,buckets=args.hash_buckets) #creates item mapping
+        classes = train_set.set_mapping(3) #creates class mapping
 
-    
-    val_set.set_mapping(3,classes) #set same class mapping
-    val_set.set_mapping(0,user_mapping,unk=0) #sets same user mapping
-    val_set.set_mapping(1,item_mapping,unk=0) #sets same item mapping
-    test_set.set_mapping(3,classes) #set same class mapping
-    test_set.set_mapping(0,user_mapping,unk=0) #sets same user mapping
-    test_set.set_mapping(1,item_mapping,unk=0) #sets same item mapping
+    eval_sets = [("valid",val_set),("test",test_set)] if val_set is not None else [("test",test_set)] # --validation 0: no validation set
+    for _,eval_set in eval_sets:
+        eval_set.set_mapping(3,classes) #set same class mapping
+        eval_set.set_mapping(0,user_mapping,unk=0) #sets same user mapping
+        eval_set.set_mapping(1,item_mapping,unk=0) #sets same item mapping
 
 
-    nusers = len(user_mapping)+1 #offset
-    nitems = len(item_mapping)+1 #offset
     num_class = len(classes)
+    mappings = {"users":user_mapping,"items":item_mapping,"classes":classes,"raw_users":raw_ids.get("users"),"raw_items":raw_ids.get("items")}
 
-    print("{} users and {} items in train dataset".format(nusers-1,nitems-1))
+    if isinstance(user_mapping,HashedMapping):
+        nusers,nitems = user_mapping.rows,item_mapping.rows
+        mappings["hashing"] = {"users":user_mapping.hashing(),"items":item_mapping.hashing()}
+
+        for f,name,m in ((0,"users",user_mapping),(1,"items",item_mapping)):
+            counts = train_set.get_stats(f)[0]
+            own = sum(c for k,c in counts.items() if k in m)
+            print("{}: {} of {} with their own row ({:.1%} of train reviews), {} hashed buckets -> {} rows instead of {}".format(name,len(m),len(counts),own/float(len(train_set)),m.buckets,m.rows,len(counts)+1))
+    else:
+        nusers = len(user_mapping)+1 #offset
+        nitems = len(item_mapping)+1 #offset
+        print("{} users and {} items in train dataset".format(nusers-1,nitems-1))
     
     
     print(25*"-"+"\nClass stats:\n" + 25*"-")
@@ -256,43 +693,99 @@ def main(args):
 
     print(25*"-" + "\nBuilding word vectors: \n"+"-"*25)
 
-    vectorizer = Vectorizer(max_word_len=args.max_words,max_sent_len=args.max_sents)
-
-    if args.load:
+    state = None
+    if resume is not None:
+        state = dict(resume["model"],word_dic=resume["word_dic"],tokenizer=resume.get("tokenizer","spacy"))
+    elif args.load:
         state = torch.load(args.load)
+
+    if isinstance(tuples,TokenStore): # reviews were tokenized by prepare_data.py: saved models must vectorize the same way
+        if args.tokenizer is not None and args.tokenizer != tuples.tokenizer:
+            raise ValueError("{} was tokenized with the {} tokenizer, not --tokenizer {}".format(args.filename,tuples.tokenizer,args.tokenizer))
+        tokenizer = tuples.tokenizer
+    elif state is not None:
+        tokenizer = state.get("tokenizer","spacy") # the word dictionnary comes with its tokenizer
+        if args.tokenizer is not None and tokenizer != args.tokenizer:
+            print("-> Using the {} tokenizer of the loaded model".format(tokenizer))
+    else:
+        tokenizer = args.tokenizer or "spacy"
+
+    vectorizer = Vectorizer(max_word_len=args.max_words,max_sent_len=args.max_sents,tokenizer=tokenizer,n_process=args.n_process)
+
+    if state is not None:
         vectorizer.word_dict = state["word_dic"]
-        net = HierarchicalDoc(ntoken=len(state["word_dic"]), nusers=nusers, nitems=nitems ,emb_size=state["embed.weight"].size(1),hid_size=state["sent.gru.weight_hh_l0"].size(1),num_class=state["lin_out.weight"].size(0))
+        net = HierarchicalDoc(ntoken=len(state["word_dic"]), nusers=nusers, nitems=nitems ,emb_size=state["embed.weight"].size(1),hid_size=state["sent.gru.weight_hh_l0"].size(1),num_class=state["lin_out.weight"].size(0),sparse=args.sparse)
         del state["word_dic"]
+        state.pop("mappings",None)
+        state.pop("precision",None)
+        state.pop("tokenizer",None)
         net.load_state_dict(state)
     else:
 
         if args.emb:
-            tensor,dic = load_embeddings(args.emb)
+            restrict = None
+            if args.emb_restrict:
+                if isinstance(tuples,TokenStore):
+                    restrict = set(w for w,c in zip(tuples.vocab,train_set.tuplelist.word_counts()) if c > 0)
+                else:
+                    restrict = set(vectorizer.count_words(train_set.field_gen(2)))
+
+            tensor,dic = load_embeddings(args.emb,restrict)
             print(len(dic))
-            net = HierarchicalDoc(ntoken=len(dic), nusers=nusers, nitems=nitems ,emb_size=len(tensor[1]),hid_size=args.hid_size,num_class=num_class)
+            net = HierarchicalDoc(ntoken=len(dic), nusers=nusers, nitems=nitems ,emb_size=len(tensor[1]),hid_size=args.hid_size,num_class=num_class,sparse=args.sparse)
             net.set_emb_tensor(torch.FloatTensor(tensor))
             vectorizer.word_dict = dic
         else:
-            vectorizer.build_dict(train_set.field_gen(2),args.max_feat)
-            net = HierarchicalDoc(ntoken=len(vectorizer.word_dict), nusers=nusers, nitems=nitems , emb_size=args.emb_size,hid_size=args.hid_size, num_class=num_class)
+            if isinstance(tuples,TokenStore):
+                vectorizer.build_dict_from_store(train_set.tuplelist,args.max_feat)
+            else:
+                vectorizer.build_dict(train_set.field_gen(2),args.max_feat)
+            net = HierarchicalDoc(ntoken=len(vectorizer.word_dict), nusers=nusers, nitems=nitems , emb_size=args.emb_size,hid_size=args.hid_size, num_class=num_class,sparse=args.sparse)
+
+
+    print(25*"-" + "\nVectorizing reviews: \n"+"-"*25)
+
+    vectorize_sets(args,tuples,vectorizer,[("train",train_set)] + eval_sets,rank,distributed)
 
+    tuple_batch = tuple_batcher_builder()
+    tuple_batch_test = tuple_batcher_builder()
 
-    tuple_batch = tuple_batcher_builder(vectorizer,trim=True)
-    tuple_batch_test = tuple_batcher_builder(vectorizer,trim=True)
+    profiler = None
+    if args.profile:
+        out = "{}.rank{}".format(args.profile,rank) if distributed else args.profile # one file per worker
+        trace = ("{}.rank{}".format(args.profile_trace,rank) if distributed else args.profile_trace) if args.profile_trace else None
+        profiler = Profiler(open(out,"w"),args.profile_every,args.cuda,rank if distributed else None,trace,args.trace_window)
+        tuple_batch = profiler.collate(tuple_batch)
 
 
     
-    if args.balance:
+    shard = {"rank":rank,"world_size":world_size}
+
+    if args.batch_tokens or args.batch_sents:
+        sampler = TokenBudgetSampler(train_set,args.batch_tokens,args.batch_sents,field=3 if args.balance else None,**shard)
+        print("-> Token budget: {} batches per epoch".format(len(sampler)))
+        batch_sampler = sampler
+    elif args.bucket:
+        sampler = LengthBucketSampler(train_set,args.b_size,field=3 if args.balance else None,**shard)
+        padding = sampler.padding_ratio()
+        shuffled = np.random.permutation(len(train_set))
+        random_padding = sampler.padding_ratio([shuffled[i:i+args.b_size] for i in range(0,len(shuffled),args.b_size)])
+        print("-> Length buckets: padding {:.1%} of words, {:.1%} of sentences (random batches: {:.1%}, {:.1%})".format(padding["words"],padding["sentences"],random_padding["words"],random_padding["sentences"]))
+        batch_sampler = sampler
+    elif args.balance:
         sampler = BucketSampler(train_set,3)
+        if distributed:
+            sampler = BucketSampler(train_set,3,num_samples=len(sampler)//world_size) # independent draws, same number of steps
+        batch_sampler = BatchSampler(sampler,args.b_size,drop_last=False)
+    else: # shuffled by seed + epoch, a resumed epoch sees the same order
+        sampler = DistributedSampler(train_set,num_replicas=world_size,rank=rank,drop_last=True)
+        batch_sampler = BatchSampler(sampler,args.b_size,drop_last=False)
 
-        dataloader = DataLoader(train_set, batch_size=args.b_size, shuffle=False, sampler=sampler, num_workers=2, collate_fn=tuple_batch,pin_memory=True)
-        dataloader_valid = DataLoader(val_set, batch_size=args.b_size, shuffle=False,  num_workers=2, collate_fn=tuple_batch_test)
-        dataloader_test = DataLoader(test_set, batch_size=args.b_size, shuffle=False,  num_workers=2, collate_fn=tuple_batch_test)
-    else:
+    batch_sampler = SkipBatches(batch_sampler)
+    dataloader = DataLoader(train_set, batch_sampler=batch_sampler, num_workers=2, collate_fn=tuple_batch,pin_memory=True)
 
-        dataloader = DataLoader(train_set, batch_size=args.b_size, shuffle=True, num_workers=2, collate_fn=tuple_batch,pin_memory=True)
-        dataloader_valid = DataLoader(val_set, batch_size=args.b_size, shuffle=False,  num_workers=2, collate_fn=tuple_batch_test)
-        dataloader_test = DataLoader(test_set, batch_size=args.b_size, shuffle=False, num_workers=2, collate_fn=tuple_batch_test)
+    dataloader_valid = eval_loader(args,val_set,tuple_batch_test,shard) if val_set is not None else None
+    dataloader_test = eval_loader(args,test_set,tuple_batch_test,shard)
 
 
     if args.weight_classes:
@@ -302,6 +795,13 @@ def main(args):
       
 
 
+    print("-> {:.2f}M parameters, {:.1f} MB (user/item tables: {:.1f} MB)".format(sum(p.numel() for p in net.parameters())/1e6,sum(p.numel()*p.element_size() for p in net.parameters())/2**20,
+                                                                           sum(p.numel()*p.element_size() for p in (net.users.weight,net.items.weight))/2**20))
+
+    if distributed:
+        Distributed.broadcast_parameters(net)
+        print("-> Data parallel training on {} workers".format(world_size))
+
     if args.cuda:
         net.cuda()
     
@@ -311,34 +811,116 @@ def main(args):
 
     check_memory(args.max_sents,args.max_words,net.emb_size,args.b_size,args.cuda)
 
-    optimizer = optim.Adam(net.parameters())#,lr=args.lr,momentum=args.momentum)
+    if args.sparse:
+        optimizer = SplitOptimizer(net)
+    else:
+        optimizer = optim.Adam(net.parameters())#,lr=args.lr,momentum=args.momentum)
     torch.nn.utils.clip_grad_norm(net.parameters(), args.clip_grad)
 
-
-    for epoch in range(1, args.epochs + 1):
-        train(epoch,net,optimizer,dataloader,criterion,args.cuda)
-        test(epoch,net,dataloader_valid,args.cuda,msg="Validation")
+    if resume is not None:
+        optimizer.load_state_dict(resume["optimizer"])
+
+    checkpointer = Checkpointer(args.checkpoint,args.keep) if args.checkpoint else None
+
+    def checkpoint(epoch,iteration,totals,epoch_rng):
+        """
+        Resumable state, saved by rank 0. Random states and epoch statistics are per worker.
+        """
+        ranks = {"rng_epoch":epoch_rng,"rng":rng_states(args.cuda,samplers=False),"totals":totals}
+        state = {"model":net.state_dict(),"optimizer":optimizer.state_dict(),"epoch":epoch,"iteration":iteration,
+                 "word_dic":vectorizer.word_dict,"tokenizer":vectorizer.tokenizer,"mappings":plain_mappings(mappings),
+                 "ranks":Distributed.all_gather_object(ranks) if distributed else [ranks]}
+        if rank == 0:
+            checkpointer.save(state,epoch,iteration)
+
+    accuracy_test = None
+    for epoch in range(resume["epoch"] if resume else 1, args.epochs + 1):
+        if hasattr(sampler,"set_epoch"):
+            sampler.set_epoch(epoch)
+
+        start,totals,rng = 0,(0,0,0),None
+        if resume is not None and epoch == resume["epoch"]:
+            saved = resume["ranks"][rank]
+            set_rng_states(saved["rng_epoch"])
+            if resume["iteration"] > 0:
+                start,totals,rng = resume["iteration"],saved["totals"],saved["rng"]
+                batch_sampler.skip = start
+
+        epoch_rng = rng_states(args.cuda)
+        on_step = None
+        if checkpointer is not None and args.checkpoint_every > 0:
+            on_step = lambda it,tot: checkpoint(epoch,it,tot,epoch_rng) if it % args.checkpoint_every == 0 else None
+
+        train(epoch,net,optimizer,dataloader,criterion,args.cuda,distributed,start=start,totals=totals,rng=rng,on_step=on_step,profiler=profiler)
+        batch_sampler.skip = 0
+        if dataloader_valid is not None:
+            test(epoch,net,dataloader_valid,args.cuda,msg="Validation",distributed=distributed)
         
 
-        if args.snapshot:
+        if args.snapshot and rank == 0:
             print("snapshot of model saved as {}".format(args.save+"_snapshot"))
-            save(net,vectorizer.word_dict,args.save+"_snapshot")
+            save(net,vectorizer.word_dict,args.save+"_snapshot",mappings,tokenizer=vectorizer.tokenizer)
+
+        accuracy_test = test(epoch,net,dataloader_test,args.cuda,distributed=distributed)
+
+        if checkpointer is not None: # next epoch from its start
+            checkpoint(epoch+1,0,(0,0,0),rng_states(args.cuda))
 
-        test(epoch,net,dataloader_test,args.cuda)
+    if checkpointer is not None:
+        checkpointer.wait()
+    if profiler is not None:
+        profiler.close()
 
-    if args.save:
+    if args.save and rank == 0:
         print("model saved to {}".format(args.save))
-        save(net,vectorizer.word_dict,args.save)
+        save(net,vectorizer.word_dict,args.save,mappings,tokenizer=vectorizer.tokenizer)
+
+    if distributed:
+        torch.distributed.destroy_process_group()
+
+    return accuracy_test
+
+
+def folds(args):
+    """
+    --folds: one training per split # of the data file, loaded once. Output files get a .split<#> suffix.
+    """
+    data = load_data(args.filename)
+    results = []
+
+    for split,train_set,val_set,test_set in TuplesListDataset.folds(data[0],data[1],args.validation,args.seed):
+        fold = argparse.Namespace(**vars(args))
+        fold.split = split
+        for name in ("save","checkpoint","profile","profile_trace"):
+            if getattr(args,name):
+                setattr(fold,name,"{}.split{}".format(getattr(args,name),split))
+        results.append((split,main(fold,data,(train_set,val_set,test_set))))
+
+    print("\n" + 25*"-")
+    for split,acc in results:
+        print("Split #{}: {}% accuracy".format(split,acc))
+    accs = np.array([acc for _,acc in results])
+    print("{} folds: {:.3f} +- {:.3f}% accuracy".format(len(accs),accs.mean(),accs.std()))
 
 
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description='Hierarchical Attention Networks for Document Classification')
     parser.add_argument("--split", type=int, default=0)
+    parser.add_argument("--folds", action='store_true',
+                        help='k-fold: train and test on every split # in turn, instead of --split')
+    parser.add_argument("--validation", type=float, default=500,
+                        help='train reviews held out for validation, a number or a fraction (0 < v < 1)')
+    parser.add_argument("--seed", type=int, default=0,
+                        help='random draw of the validation reviews')
     parser.add_argument("--emb-size",type=int,default=200)
     parser.add_argument("--hid-size",type=int,default=50)
     parser.add_argument("--weight-classes", action='store_true')
     parser.add_argument("--b-size", type=int, default=32)
+    parser.add_argument("--batch-tokens", type=int,
+                        help='batch by budget: max padded words (sentences x longest sentence) per batch, instead of --b-size')
+    parser.add_argument("--batch-sents", type=int,
+                        help='batch by budget: max sentences per batch, instead of --b-size')
     parser.add_argument("--max-feat", type=int,default=10000)
     parser.add_argument("--epochs", type=int,default=10)
     parser.add_argument("--clip-grad", type=float,default=1)
@@ -346,17 +928,61 @@ if __name__ == '__main__':
     parser.add_argument("--max-words", type=int,default=32)
     parser.add_argument("--max-sents",type=int,default=16)
     parser.add_argument("--momentum",type=float,default=0.9)
-    parser.add_argument("--emb", type=str)
+    parser.add_argument("--emb", type=str,
+                        help='word2vec text file or .npy made by convert_emb.py')
+    parser.add_argument("--emb-restrict", action='store_true',
+                        help='only load embeddings of words found in the training data')
+    parser.add_argument("--tokenizer", choices=TOKENIZERS,
+                        help='sentence splitting and tokenization: full spaCy pipeline (parser, default), spaCy sentencizer (rules, much faster) or regex (no spaCy). Token stores keep the tokenizer they were written with')
+    parser.add_argument("--n-process", type=int, default=1,
+                        help='spaCy tokenizer processes when vectorizing')
     parser.add_argument("--load", type=str)
+    parser.add_argument("--evaluate", action='store_true',
+                        help='only evaluate the --load model on the test split (saved mappings and tokenizer, no training setup)')
     parser.add_argument("--save", type=str)
     parser.add_argument("--snapshot", action='store_true')
+    parser.add_argument("--profile", type=str,
+                        help='write per stage step times, reviews/tokens per second, padding and peak RSS as json lines to this file (see Profiling.py)')
+    parser.add_argument("--profile-every", type=int, default=50,
+                        help='training steps per --profile line')
+    parser.add_argument("--profile-trace", type=str,
+                        help='with --profile, also export a torch.profiler chrome trace of the --trace-window steps to this file')
+    parser.add_argument("--trace-window", type=int, nargs=2, default=[10,5], metavar=("START","STEPS"),
+                        help='first traced step and number of traced steps')
+    parser.add_argument("--checkpoint", type=str,
+                        help='resumable checkpoints (weights, optimizer, epoch position, random states, mappings) saved as PREFIX.<epoch>.<iteration>.ckpt')
+    parser.add_argument("--checkpoint-every", type=int, default=0,
+                        help='also checkpoint every N training steps (0: at the end of each epoch only)')
+    parser.add_argument("--keep", type=int, default=3,
+                        help='number of checkpoints kept')
+    parser.add_argument("--resume", type=str, nargs="?", const="latest",
+                        help='continue training from a checkpoint (default: the latest of --checkpoint), mid-epoch if needed')
     parser.add_argument("--output", type=str)
+    parser.add_argument("--cache-dir", type=str,
+                        help='where vectorized reviews are cached (defaults to the data file directory)')
     parser.add_argument('--cuda', action='store_true',
                         help='use CUDA')
     parser.add_argument('--balance', action='store_true',
                         help='balance class in batches')
+    parser.add_argument('--bucket', action='store_true',
+                        help='batch reviews of similar lengths together (less padding)')
+    parser.add_argument("--min-count", type=int, default=1,
+                        help='users/items with fewer train reviews share rows (see --hash-buckets)')
+    parser.add_argument("--hash-buckets", type=int, default=0,
+                        help='rows shared by rare and unseen users/items, by id hash (0: they all get the unknown row)')
+    parser.add_argument('--sparse', action='store_true',
+                        help='sparse gradients for the word/user/item embeddings, updated by SparseAdam (cost follows the batch ids, not the table sizes)')
+    parser.add_argument('--distributed', action='store_true',
+                        help='data parallel training over the workers started by torchrun (gloo, see Distributed.py)')
     parser.add_argument('filename', type=str)
     args = parser.parse_args()
 
+    if args.evaluate and not args.load:
+        parser.error("--evaluate needs a model to --load")
+    if args.folds and (args.evaluate or args.resume):
+        parser.error("--folds trains every split, it cannot be used with --evaluate or --resume")
 
-    main(args)
+    if args.folds:
+        folds(args)
+    else:
+        main(args)
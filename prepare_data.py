@@ -1,116 +1,310 @@
-import spacy
 import gzip
 import argparse
-import gensim
 import logging
 import json
+import os
+import shutil
+import tempfile
 import pickle as pkl
+import numpy as np
+
+from array import array
+from multiprocessing import Pool
+from collections import Counter, deque
 
 from tqdm import tqdm
-from random import randint
-from collections import Counter, Iterator
 
 
 logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO) #gensim logging
 
-#Global dicts for users
-USERS = {}
-ITEMS = {}
-
-def count_lines(file):
-    count = 0
-    for _ in file:
-        count += 1
-    file.seek(0)
-    return count
+NLP = None #per worker spacy pipeline (spacy and gensim are imported when needed: they take seconds to load)
+
+
+def read_shards(path,shard_size):
+    """
+    Single pass over the gzip file, yields (shard #, list of json lines)
+    """
+    with gzip.open(path,"r") as f:
+        shard = []
+        n = 0
+        for line in f:
+            shard.append(line)
+            if len(shard) == shard_size:
+                yield n,shard
+                shard = []
+                n += 1
+        if len(shard) > 0:
+            yield n,shard
+
+
+def ordered_map(pool,fn,jobs,max_pending):
+    """
+    pool.imap keeping at most max_pending jobs in flight (imap would read the whole input ahead)
+    """
+    pending = deque()
+    for job in jobs:
+        pending.append(pool.apply_async(fn,(job,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while len(pending) > 0:
+        yield pending.popleft().get()
+
+
+def init_worker(tokenize,split_sents):
+    global NLP
+    if tokenize:
+        import spacy
+        NLP = spacy.load('en') if split_sents else spacy.load('en',disable=["tagger","parser","ner"])
+
+
+def get_rating(data,rescale):
+    rating = max(1,int(round(float(data["overall"]))))-1 #zero is useless, classes between 0-4 for 1-5 reviews
+
+    if rescale:
+        if rating == 3:
+            return None
+        return 1 if rating > 3 else 0
+
+    return rating
+
+
+def process_shard(job):
+    """
+    Parses and tokenizes one shard. Users, items and words get shard-local ids, made global by merge_shards.
+    Writes shard_<n>.pkl in out_dir and returns its path.
+    """
+    n,lines,out_dir,args = job
+
+    users,items,ratings,texts = {},{},array("i"),[]
+    u_ids,i_ids = array("i"),array("i")
+
+    for line in lines:
+        data = json.loads(line)
+        rating = get_rating(data,args["rescale"])
+
+        if rating is None:
+            continue
+
+        u_ids.append(users.setdefault(data["reviewerID"],len(users)))
+        i_ids.append(items.setdefault(data["asin"],len(items)))
+        ratings.append(rating)
+        texts.append(data["reviewText"])
+
+    shard = {"users":list(users),"items":list(items),"u_ids":np.frombuffer(u_ids,dtype=np.int32),
+             "i_ids":np.frombuffer(i_ids,dtype=np.int32),"ratings":np.frombuffer(ratings,dtype=np.int32)}
+
+    if args["keep_text"]:
+        shard["texts"] = texts
+
+    if args["tokenize"]:
+        vocab = {}
+        words,sent_lens,rev_lens = array("i"),array("q"),array("q")
+
+        docs = NLP.pipe(texts,batch_size=1000) if args["split_sents"] else NLP.tokenizer.pipe(texts,batch_size=1000)
+
+        for doc in docs:
+            sents = doc.sents if args["split_sents"] else [doc]
+            n_sents = 0
+            for sent in sents:
+                if len(sent) == 0:
+                    continue
+                words.extend(vocab.setdefault(w.lower_,len(vocab)) for w in sent)
+                sent_lens.append(len(sent))
+                n_sents += 1
+            rev_lens.append(n_sents)
+
+        shard["vocab"] = list(vocab)
+        shard["words"] = np.frombuffer(words,dtype=np.int32)
+        shard["counts"] = np.bincount(shard["words"],minlength=len(vocab))
+        shard["sent_lens"] = np.frombuffer(sent_lens,dtype=np.int64)
+        shard["rev_lens"] = np.frombuffer(rev_lens,dtype=np.int64)
+
+    path = os.path.join(out_dir,"shard_{:06d}.pkl".format(n))
+    with open(path,"wb") as f:
+        pkl.dump(shard,f,protocol=pkl.HIGHEST_PROTOCOL)
+
+    return path,len(lines),len(texts)
+
+
+def merge_shards(shard_paths):
+    """
+    Deterministic merge, in shard order: users/items get global ids by first appearance (as a sequential pass would)
+    and words are ordered by frequency (ties by first appearance) starting at 2, 0 is padding and 1 unknown word.
+    Returns global dicts and per shard local->global id arrays.
+    """
+    users,items,word_ids = {},{},{}
+    word_counts = []
+    maps = []
+
+    for path in tqdm(shard_paths,desc="Merging ids"):
+        with open(path,"rb") as f:
+            shard = pkl.load(f)
+
+        m = {"users":np.array([users.setdefault(u,len(users)) for u in shard["users"]],dtype=np.int32),
+             "items":np.array([items.setdefault(i,len(items)) for i in shard["items"]],dtype=np.int32),
+             "sizes":(len(shard.get("words",())),len(shard.get("sent_lens",())),len(shard["ratings"]))}
+
+        if "vocab" in shard:
+            local = np.array([word_ids.setdefault(w,len(word_ids)) for w in shard["vocab"]],dtype=np.int64)
+            word_counts.extend([0] * (len(word_ids) - len(word_counts)))
+            for g,c in zip(local.tolist(),shard["counts"].tolist()):
+                word_counts[g] += c
+            m["words"] = local
+
+        maps.append(m)
+
+    vocab = ["_padding_","_unk_word_"]
+    if len(word_ids) > 0:
+        by_freq = np.argsort(-np.array(word_counts,dtype=np.int64),kind="stable")
+        remap = np.empty(len(word_ids),dtype=np.int32)
+        remap[by_freq] = np.arange(2,len(word_ids)+2,dtype=np.int32)
+        words_by_first = list(word_ids)
+        vocab += [words_by_first[i] for i in by_freq]
+
+        for m in maps:
+            m["words"] = remap[m["words"]]
+
+    return users,items,vocab,maps
+
+
+def write_store(path,shard_paths,maps,vocab,users,items,splits):
+    """
+    Writes a columnar store read by Data.TokenStore:
+    words.npy (int32 word ids), sent_offsets.npy/rev_offsets.npy (int64), users/items/ratings/splits.npy (int32),
+    vocab.json, users.json/items.json (raw ids, in id order) and meta.json (tokenizer, see Data.TOKENIZERS).
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    n_words,n_sents,n_revs = (sum(x) for x in zip(*(m["sizes"] for m in maps)))
+    out = {"words":np.lib.format.open_memmap(os.path.join(path,"words.npy"),mode="w+",dtype=np.int32,shape=(n_words,))}
+    sent_lens = np.zeros(n_sents,dtype=np.int64)
+    rev_lens = np.zeros(n_revs,dtype=np.int64)
+    cols = {c:np.zeros(n_revs,dtype=np.int32) for c in ("users","items","ratings")}
+
+    w = s = r = 0
+    for p,m in tqdm(zip(shard_paths,maps),total=len(maps),desc="Writing store"):
+        nw,ns,nr = m["sizes"]
+        with open(p,"rb") as f:
+            shard = pkl.load(f)
+        out["words"][w:w+nw] = m["words"][shard["words"]]
+        sent_lens[s:s+ns] = shard["sent_lens"]
+        rev_lens[r:r+nr] = shard["rev_lens"]
+        cols["users"][r:r+nr] = m["users"][shard["u_ids"]]
+        cols["items"][r:r+nr] = m["items"][shard["i_ids"]]
+        cols["ratings"][r:r+nr] = shard["ratings"]
+        w,s,r = w+nw,s+ns,r+nr
+
+    out["words"].flush()
+    del out
+
+    for name,lens in (("sent_offsets",sent_lens),("rev_offsets",rev_lens)):
+        offsets = np.zeros(len(lens)+1,dtype=np.int64)
+        np.cumsum(lens,out=offsets[1:])
+        np.save(os.path.join(path,name+".npy"),offsets)
+
+    for name,col in cols.items():
+        np.save(os.path.join(path,name+".npy"),col)
+    np.save(os.path.join(path,"splits.npy"),splits.astype(np.int32))
+
+    for name,obj in (("vocab",vocab),("users",list(users)),("items",list(items)),("meta",{"tokenizer":"spacy"})): # full pipeline, see init_worker
+        with open(os.path.join(path,name+".json"),"w") as f:
+            json.dump(obj,f)
+
+    print("Store written to {}: {} reviews, {} sentences, {} words, {} distinct".format(path,n_revs,n_sents,n_words,len(vocab)))
+
+
+class StoreSentences(object):
+    """
+    Restartable iterable over the reviews of a token store as lists of words (word2vec input).
+    Word ids are read chunk by chunk through a memory map so memory stays bounded whatever the corpus size.
+    """
+
+    def __init__(self,path,chunk_size=10000):
+        self.path = path
+        self.chunk_size = chunk_size
+
+        with open(os.path.join(path,"vocab.json")) as f:
+            self.vocab = json.load(f)
+        self.keep = np.array([len(w.strip()) >= 1 for w in self.vocab]) #whitespace shouldn't be a word.
+
+    def __iter__(self):
+        words = np.load(os.path.join(self.path,"words.npy"),mmap_mode="r")
+        sent_offsets = np.load(os.path.join(self.path,"sent_offsets.npy"),mmap_mode="r")
+        rev_offsets = np.load(os.path.join(self.path,"rev_offsets.npy"),mmap_mode="r")
+
+        for c in range(0,len(rev_offsets)-1,self.chunk_size):
+            offsets = sent_offsets[rev_offsets[c:c+self.chunk_size+1]]
+            ids = np.asarray(words[offsets[0]:offsets[-1]])
+            keep = self.keep[ids]
+
+            for s,e in zip(offsets[:-1]-offsets[0],offsets[1:]-offsets[0]):
+                yield [self.vocab[i] for i in ids[s:e][keep[s:e]].tolist()]
 
 
 def build_dataset(args):
 
-    def preprocess(datas):
-        for data in datas:
-
-            uk = USERS.setdefault(data["reviewerID"], len(USERS))
-            ik = ITEMS.setdefault(data["asin"], len(ITEMS))
-
-            yield (uk,ik,data['reviewText'],max(1,int(round(float(data["overall"]))))-1) #zero is useless, classes between 0-4 for 1-5 reviews
-
-    def preprocess_rescale(datas):
-        for data in datas:
-
-            uk = USERS.setdefault(data["reviewerID"], len(USERS))
-            ik = ITEMS.setdefault(data["asin"], len(ITEMS))
-
-            rating = max(1,int(round(float(data["overall"]))))-1
-
-            if rating > 3:
-                rating = 1
-            elif rating == 3:
-                yield None
-                continue
-            else:
-                rating = 0
-            yield (uk, ik, data['reviewText'],rating) #zero is useless
-
-    def data_generator(data):
-        with gzip.open(args.input,"r") as f:
-            for x in tqdm(f,desc="Reviews",total=count_lines(f)):
-                yield json.loads(x)
-
-    class TokIt(Iterator):
-        def __init__(self, tokenized):
-            self.tok = tokenized
-            self.x = 0
-            self.stop = len(tokenized)
-
-        def __iter__(self):
-            return self
-
-        def next(self):
-            if self.x < self.stop:
-                self.x += 1
-                return list(w.orth_ for w in self.tok[self.x-1] if len(w.orth_.strip()) >= 1 ) #whitespace shouldn't be a word.
-            else:
-                self.x = 0
-                raise StopIteration 
-        __next__ = next
+    print("Building dataset from : {}".format(args.input))
+    print("-> Building {} random splits".format(args.nb_splits))
 
+    if args.rescale:
+        print("-> Rescaling data to 0-1 (3's are discarded)")
 
+    tokenize = args.store or args.create_emb
+    job_args = {"rescale":args.rescale,"tokenize":tokenize,"split_sents":args.store,"keep_text":not args.store}
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(args.output)))
 
+    try:
+        jobs = ((n,lines,tmp_dir,job_args) for n,lines in read_shards(args.input,args.shard_size))
+        pool = Pool(args.workers,initializer=init_worker,initargs=(tokenize,args.store))
+        shard_paths = []
+        n_revs = 0
 
-    print("Building dataset from : {}".format(args.input))
-    print("-> Building {} random splits".format(args.nb_splits))
+        with tqdm(desc="Reviews") as pbar:
+            for path,n_lines,n_kept in ordered_map(pool,process_shard,jobs,2*args.workers):
+                shard_paths.append(path)
+                n_revs += n_kept
+                pbar.update(n_lines)
 
-    nlp = spacy.load('en')
+        pool.close()
+        pool.join()
 
-    tokenized = [tok for tok in tqdm(nlp.tokenizer.pipe((x["reviewText"] for x in data_generator(args.input)), batch_size=10000, n_threads=8),desc="Tokenizing")]
+        users,items,vocab,maps = merge_shards(shard_paths)
+        splits = np.random.RandomState(args.seed).randint(0,args.nb_splits,size=n_revs)
 
-    
+        print("Split distribution is the following:")
+        print(Counter(splits.tolist()))
 
-    if args.create_emb:
-        w2vmodel = gensim.models.Word2Vec(TokIt(tokenized), size=args.emb_size, window=5, min_count=5, iter=args.epochs, max_vocab_size=args.dic_size, workers=4)
-        print(len(w2vmodel.wv.vocab))
-        w2vmodel.wv.save_word2vec_format(args.emb_file,total_vec=len(w2vmodel.wv.vocab))        
+        if tokenize:
+            token_dir = args.output if args.store else os.path.join(tmp_dir,"tokens")
+            write_store(token_dir,shard_paths,maps,vocab,users,items,splits)
 
-    if args.rescale:
-        print("-> Rescaling data to 0-1 (3's are discarded)")
-        data = [dt for dt in tqdm(preprocess_rescale(data_generator(args.input)),desc="Processing") if dt is not None]
-    else:
-        data = [dt for dt in tqdm(preprocess(data_generator(args.input)),desc="Processing")]
+        if args.create_emb:
+            import gensim
+            w2vmodel = gensim.models.Word2Vec(StoreSentences(token_dir), size=args.emb_size, window=5, min_count=5, iter=args.epochs, max_vocab_size=args.dic_size, workers=4)
+            print(len(w2vmodel.wv.vocab))
+            w2vmodel.wv.save_word2vec_format(args.emb_file,total_vec=len(w2vmodel.wv.vocab))
 
+        if args.store:
+            return None
 
-    splits = [randint(0,args.nb_splits-1) for _ in range(0,len(data))]
-    count = Counter(splits)
+        data = []
+        for p,m in tqdm(zip(shard_paths,maps),total=len(maps),desc="Processing"):
+            with open(p,"rb") as f:
+                shard = pkl.load(f)
+            data.extend(zip(m["users"][shard["u_ids"]].tolist(),m["items"][shard["i_ids"]].tolist(),shard["texts"],shard["ratings"].tolist()))
 
-    print("Split distribution is the following:")
-    print(count)
+    finally:
+        shutil.rmtree(tmp_dir)
 
-    return {"data":data,"splits":splits,"rows":("user_id","item_id","review","rating")}
+    return {"data":data,"splits":splits.tolist(),"rows":("user_id","item_id","review","rating"),"users":users,"items":items}
 
 
 def main(args):
     ds = build_dataset(args)
-    pkl.dump(ds,open(args.output,"wb"))
+
+    if ds is not None:
+        pkl.dump(ds,open(args.output,"wb"))
 
 if __name__ == '__main__':
 
@@ -119,6 +313,10 @@ if __name__ == '__main__':
     parser.add_argument("output", type=str, default="sentences.pkl")
     parser.add_argument("--rescale",action="store_true")
     parser.add_argument("--nb_splits",type=int, default=5)
+    parser.add_argument("--seed",type=int, default=1337, help="seed of the random splits")
+    parser.add_argument("--store",action="store_true",help="write a memory-mapped columnar store (directory) instead of a pickle")
+    parser.add_argument("--workers",type=int, default=os.cpu_count(), help="tokenizing processes")
+    parser.add_argument("--shard-size",type=int, default=10000, help="reviews per shard")
 
     parser.add_argument("--create-emb",action="store_true")
     parser.add_argument("--emb-file", type=str, default=None)
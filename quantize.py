@@ -0,0 +1,100 @@
+import time
+import argparse
+
+import numpy as np
+import torch
+
+from main import load_model, load_data, save, PRECISIONS
+from score import Scorer
+from Data import TuplesListDataset, TokenStore, Vectorizer
+
+# Exports a model saved by main.py --save for CPU inference in int8 (dynamic quantization of the GRU and Linear layers)
+# or bf16 (bfloat16 autocast): score.py and server.py then run it in that precision.
+# Given the data file it was trained on, the fp32, bf16 and int8 variants are compared on the test split
+# (accuracy, agreement with fp32 predictions, largest probability change) and timed: latency of a single review,
+# throughput with --b-size reviews per forward pass.
+
+
+def held_out(filename,split,scorer,max_sents,max_words):
+    """
+    Users, items, vectorized reviews and classes of the test split, mapped as for training (-1: class unknown to the model)
+    """
+    tuples,splits,_ = load_data(filename)
+    _,_,test_set = TuplesListDataset.build_train_test(tuples,splits,split) # the test split does not depend on validation
+
+    if isinstance(tuples,TokenStore):
+        test_set.tuplelist.set_word_dict(scorer.word_dict,max_sents,max_words)
+        revs = [test_set[i][2] for i in range(len(test_set))]
+    else:
+        vectorizer = Vectorizer(scorer.word_dict,max_sent_len=max_sents,max_word_len=max_words,tokenizer=scorer.net.tokenizer)
+        revs = vectorizer.vectorize_batch(list(test_set.field_gen(2)),trim=True)
+
+    users = [scorer.map_id(u,"users") for u in test_set.field_gen(0)]
+    items = [scorer.map_id(i,"items") for i in test_set.field_gen(1)]
+    classes = np.array([scorer.mappings["classes"].get(r,-1) for r in test_set.field_gen(3)])
+
+    return users,items,revs,classes
+
+
+def timed(fn,number):
+    times = []
+    for _ in range(number):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter()-start)
+    return np.array(times)
+
+
+def main(args):
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    if args.output:
+        net,word_dict,mappings = load_model(args.model,"fp32")
+        save(net,word_dict,args.output,mappings,precision=args.precision,tokenizer=net.tokenizer)
+        print("-> {} model saved to {}".format(args.precision,args.output))
+
+    if args.data is None:
+        return
+
+    held = None
+    ref = None
+
+    for precision in PRECISIONS:
+        scorer = Scorer(args.model,args.b_size,precision=precision)
+        if scorer.mappings is None:
+            raise ValueError("{} has no user/item mappings, save it again with main.py --save".format(args.model))
+
+        if held is None:
+            held = held_out(args.data,args.split,scorer,args.max_sents,args.max_words)
+        users,items,revs,classes = held
+
+        probs = scorer.predict(users,items,revs).numpy()
+        preds = probs.argmax(1)
+        if ref is None:
+            ref = probs
+
+        n = min(args.number,len(revs))
+        latency = timed(lambda: [scorer.predict(users[i:i+1],items[i:i+1],revs[i:i+1]) for i in range(n)],1)[0] / n
+        throughput = len(revs) / timed(lambda: scorer.predict(users,items,revs),args.repeat).min()
+
+        print("{:5} accuracy {:6.2%}  agreement with fp32 {:7.2%}  max prob change {:.4f}  latency {:6.2f} ms/review  throughput {:8.1f} reviews/s".format(
+              precision,(preds == classes).mean(),(preds == ref.argmax(1)).mean(),np.abs(probs-ref).max(),latency*1e3,throughput))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Quantized / bfloat16 export of a saved Hierarchical Attention Network, with accuracy check and benchmark')
+    parser.add_argument("model", type=str, help="model saved by main.py --save")
+    parser.add_argument("data", type=str, nargs="?", help="data the model was trained on (prepare_data.py output), to check and time each precision on its test split")
+    parser.add_argument("--output", type=str, help="exported model path")
+    parser.add_argument("--precision", choices=PRECISIONS, default="int8", help="precision of the exported model")
+    parser.add_argument("--split", type=int, default=0)
+    parser.add_argument("--b-size", type=int, default=64, help="reviews per forward pass (throughput)")
+    parser.add_argument("--number", type=int, default=200, help="reviews scored one by one (latency)")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--threads", type=int, help="torch cpu threads")
+    parser.add_argument("--max-words", type=int,default=32)
+    parser.add_argument("--max-sents",type=int,default=16)
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,241 @@
+import sys
+import json
+import time
+import argparse
+
+from collections import deque
+from multiprocessing import Pool
+
+import torch
+import torch.nn.functional as F
+from tqdm import tqdm
+
+from main import load_model, pad_batch, plain_mappings, PRECISIONS
+from Data import Vectorizer
+
+# Scores reviews with a model saved by main.py --save.
+# Input: json lines with user ("user" or "reviewerID"), item ("item" or "asin") and text ("review" or "reviewText"), from a file or stdin.
+# Output: one json line per review, in input order, with the predicted rating and class probabilities.
+# Lines that can't be scored (invalid json, missing or mistyped fields) get {"line":..,"error":..} (and "id") instead.
+
+
+VECTORIZER = None #per worker vectorizer
+
+
+def init_vectorizer(word_dict,max_sents,max_words,tokenizer="spacy"):
+    global VECTORIZER
+    VECTORIZER = Vectorizer(word_dict,max_sent_len=max_sents,max_word_len=max_words,tokenizer=tokenizer)
+
+
+def vectorize(texts):
+    return [[s.numpy() for s in r] for r in VECTORIZER.vectorize_batch(texts,trim=True)]
+
+
+class Scorer(object):
+    """
+    Runs a saved HierarchicalDoc in eval mode without autograd.
+    Reviews are scored in micro-batches of similar lengths, probabilities are returned in input order.
+    """
+
+    def __init__(self,path,b_size=64,cuda=False,bias_cache=0,sentence_cache=0,precision=None):
+        self.net,self.word_dict,self.mappings = load_model(path,precision)
+        self.net.eval()
+        if bias_cache > 0:
+            self.net.enable_bias_cache(bias_cache)
+        if sentence_cache > 0:
+            self.net.enable_sentence_cache(sentence_cache)
+        self.b_size = b_size
+        self.cuda = cuda
+
+        if cuda:
+            self.net.cuda()
+
+        n_class = self.net.lin_out.out_features
+        self.labels = list(range(n_class))
+        if self.mappings is not None:
+            for label,c in self.mappings["classes"].items():
+                self.labels[c] = label
+
+    def reload(self,path):
+        """
+        Loads the weights of another save of the same model (same word dictionnary and mappings, e.g. retrained top layers).
+        Cached sentences and biases stay valid as long as the weights they were computed from did not change.
+        """
+        net,word_dict,mappings = load_model(path,self.net.precision)
+        if word_dict != self.word_dict:
+            raise ValueError("{} has another word dictionnary".format(path))
+        if (mappings is None) != (self.mappings is None) or (mappings is not None and plain_mappings(mappings) != plain_mappings(self.mappings)):
+            raise ValueError("{} has other user/item/class mappings".format(path))
+
+        self.net.load_state_dict(net.state_dict())
+
+        if self.net.precision == "int8": # quantized GRU/Linear weights are not tensors the caches can check
+            for cache in list((self.net.bias_cache or {}).values()) + [self.net.sentence_cache]:
+                if cache is not None:
+                    cache.clear()
+
+    def map_id(self,key,field):
+        """
+        Embedding row of a user/item (raw or prepared id), 0 (unknown) if it wasn't seen in training
+        """
+        table = self.net.users if field == "users" else self.net.items
+
+        if self.mappings is None:
+            return key if isinstance(key,int) and 0 <= key < table.num_embeddings else 0
+
+        raw = self.mappings.get("raw_"+field)
+        if raw is not None and key in raw:
+            key = raw[key]
+
+        return self.mappings[field].get(key,0)
+
+    def predict(self,users,items,list_rev):
+        """
+        Class probabilities (n x n_class) of vectorized reviews (lists of LongTensor sentences)
+        """
+        order = sorted(range(len(list_rev)),key=lambda i:(len(list_rev[i]),max(len(s) for s in list_rev[i])))
+        probs = torch.zeros(len(list_rev),len(self.labels))
+
+        with torch.no_grad(), torch.autocast("cpu",dtype=torch.bfloat16,enabled=self.net.precision == "bf16"):
+            for c in range(0,len(order),self.b_size):
+                idx = order[c:c+self.b_size]
+                batch_t,stat = pad_batch([list_rev[i] for i in idx])
+                u_t = torch.LongTensor([users[i] for i in idx])
+                i_t = torch.LongTensor([items[i] for i in idx])
+
+                if self.cuda:
+                    batch_t,u_t,i_t = batch_t.cuda(),u_t.cuda(),i_t.cuda()
+
+                probs[torch.LongTensor(idx)] = F.softmax(self.net(batch_t,u_t,i_t,stat).float(),1).cpu()
+
+        return probs
+
+
+def read_chunks(f,size):
+    """
+    Chunks of (line #, row, error) of the non empty lines, error being None or why the row can't be scored
+    """
+    chunk = []
+    for n,line in enumerate(f,1):
+        if len(line.strip()) == 0:
+            continue
+        row,error = None,None
+        try:
+            row = json.loads(line)
+            check_row(row)
+        except (ValueError,KeyError) as e:
+            error = e
+        chunk.append((n,row,error))
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+
+def field(row,*keys):
+    for k in keys:
+        if k in row:
+            return row[k]
+    raise KeyError("None of {} in input row".format(keys))
+
+
+def check_row(row):
+    """
+    Raises ValueError (KeyError for a missing field) for rows that can't be scored: review must be a string, user/item ids strings or integers
+    """
+    if not isinstance(row,dict):
+        raise ValueError("Row must be a json object")
+
+    for keys,types in ((("user","reviewerID"),(str,int)),(("item","asin"),(str,int)),(("review","reviewText"),(str,))):
+        value = field(row,*keys)
+        if not isinstance(value,types) or isinstance(value,bool):
+            raise ValueError("{} must be {}, not {}".format(keys[0]," or ".join(t.__name__ for t in types),type(value).__name__))
+
+
+def main(args):
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    scorer = Scorer(args.model,args.b_size,args.cuda,args.bias_cache,args.sentence_cache,args.precision)
+    init = (scorer.word_dict,args.max_sents,args.max_words,scorer.net.tokenizer)
+
+    if args.workers > 0:
+        pool = Pool(args.workers,initializer=init_vectorizer,initargs=init)
+        submit = lambda texts: pool.apply_async(vectorize,(texts,))
+    else:
+        init_vectorizer(*init)
+        pool = None
+        submit = lambda texts: vectorize(texts)
+
+    inp = sys.stdin if args.input == "-" else open(args.input)
+    out = sys.stdout if args.output == "-" else open(args.output,"w")
+    pending = deque()
+    n = errors = 0
+    start = time.time()
+
+    def write(rows,vect):
+        nonlocal errors
+        good = [r for _,r,e in rows if e is None]
+        revs = [[torch.from_numpy(s) for s in r] for r in (vect if pool is None else vect.get())]
+        users = [scorer.map_id(field(r,"user","reviewerID"),"users") for r in good]
+        items = [scorer.map_id(field(r,"item","asin"),"items") for r in good]
+        probs = scorer.predict(users,items,revs) if len(good) > 0 else torch.zeros(0,len(scorer.labels))
+        scored = iter(zip(probs.max(1)[1].tolist(),probs.tolist()))
+
+        for line,r,e in rows:
+            if e is not None:
+                errors += 1
+                res = {"line":line,"error":str(e)}
+            else:
+                p,pr = next(scored)
+                res = {"pred":scorer.labels[p],"probs":pr}
+            if isinstance(r,dict) and "id" in r:
+                res["id"] = r["id"]
+            out.write(json.dumps(res)+"\n")
+        out.flush()
+        return len(good)
+
+    with tqdm(desc="Scoring",unit="rev",file=sys.stderr) as pbar:
+        for rows in read_chunks(inp,args.chunk):
+            pending.append((rows,submit([field(r,"review","reviewText") for _,r,e in rows if e is None])))
+
+            if len(pending) > 2*max(args.workers,1):
+                k = write(*pending.popleft())
+                n += k
+                pbar.update(k)
+
+        while len(pending) > 0:
+            k = write(*pending.popleft())
+            n += k
+            pbar.update(k)
+
+    elapsed = time.time() - start
+    print("Scored {} reviews in {:.1f}s: {:.1f} reviews/sec".format(n,elapsed,n/max(elapsed,1e-9)),file=sys.stderr)
+    if errors > 0:
+        print("{} lines could not be scored (error lines in the output)".format(errors),file=sys.stderr)
+    if scorer.net.sentence_cache is not None:
+        print("Sentence cache: {}".format(json.dumps(scorer.net.sentence_cache.stats())),file=sys.stderr)
+
+    if pool is not None:
+        pool.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Batch scoring with a saved Hierarchical Attention Network')
+    parser.add_argument("model", type=str, help="model saved by main.py --save")
+    parser.add_argument("input", type=str, nargs="?", default="-", help="json lines file, - for stdin")
+    parser.add_argument("--output", type=str, default="-", help="predictions file, - for stdout")
+    parser.add_argument("--b-size", type=int, default=64, help="reviews per forward pass")
+    parser.add_argument("--chunk", type=int, default=2048, help="reviews vectorized per job and sorted by length together")
+    parser.add_argument("--workers", type=int, default=2, help="vectorization processes (0: in process)")
+    parser.add_argument("--threads", type=int, help="torch cpu threads")
+    parser.add_argument("--max-words", type=int,default=32)
+    parser.add_argument("--max-sents",type=int,default=16)
+    parser.add_argument("--bias-cache", type=int, default=0, help="cache the user/item attention biases of at most N ids per table (0: off)")
+    parser.add_argument("--sentence-cache", type=float, default=0, help="reuse word-level GRU outputs of already seen sentences, at most N MB (0: off)")
+    parser.add_argument("--precision", choices=PRECISIONS, help="overrides the precision saved with the model (see quantize.py)")
+    parser.add_argument('--cuda', action='store_true')
+    args = parser.parse_args()
+
+    main(args)
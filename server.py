@@ -0,0 +1,248 @@
+import json
+import time
+import asyncio
+import argparse
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from score import Scorer, field, check_row
+from main import PRECISIONS
+from Data import Vectorizer
+
+# Online scoring over HTTP with a model saved by main.py --save.
+# POST /predict  {"user":..,"item":..,"review":..}  ->  {"pred":..,"probs":[..]}
+# GET  /metrics  latency percentiles and batch sizes
+# POST /reload   {"model":..}  loads the weights of another save of the model (see score.Scorer.reload): caches are kept
+#                for the layers that did not change, e.g. when only the top layers were retrained
+# Requests arriving within --window ms are scored together: the GRUs run once per batch, not once per request.
+
+
+class MicroBatcher(object):
+    """
+    Collects requests for at most window seconds (or max_batch requests) and scores them in one forward pass,
+    on a single background thread so that the event loop keeps accepting requests.
+    """
+
+    def __init__(self,scorer,vectorizer,window=0.005,max_batch=64,history=10000):
+        self.scorer = scorer
+        self.vectorizer = vectorizer
+        self.window = window
+        self.max_batch = max_batch
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.latencies = deque(maxlen=history)
+        self.batch_sizes = deque(maxlen=history)
+        self.n_requests = 0
+        self.n_batches = 0
+
+    async def predict(self,row):
+        check_row(row) # bad requests fail alone, not their batch
+
+        future = asyncio.get_event_loop().create_future()
+        await self.queue.put((time.time(),row,future))
+        return await future
+
+    async def reload(self,path):
+        """
+        Loads new weights on the scoring thread, between two batches
+        """
+        await asyncio.get_event_loop().run_in_executor(self.executor,self.scorer.reload,path)
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.window
+
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(),timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                results = await loop.run_in_executor(self.executor,self._score,[row for _,row,_ in batch])
+            except Exception as e:
+                results = [e] * len(batch)
+
+            end = time.time()
+            self.n_batches += 1
+            self.batch_sizes.append(len(batch))
+
+            for (start,_,future),res in zip(batch,results):
+                self.n_requests += 1
+                self.latencies.append(end - start)
+                if isinstance(res,Exception):
+                    future.set_exception(res)
+                else:
+                    future.set_result(res)
+
+    def _score(self,rows):
+        """
+        Results of rows, or the exception of each row that could not be vectorized/mapped (the others are still scored)
+        """
+        texts = [field(r,"review","reviewText") for r in rows]
+        try:
+            revs = self.vectorizer.vectorize_batch(texts,trim=True)
+        except Exception: # one stream for the batch: find the failing rows one by one
+            revs = []
+            for text in texts:
+                try:
+                    revs.append(self.vectorizer.vectorize_batch([text],trim=True)[0])
+                except Exception as e:
+                    revs.append(e)
+
+        results = []
+        for r,rev in zip(rows,revs):
+            try:
+                if isinstance(rev,Exception):
+                    raise rev
+                if len(rev) == 0:
+                    raise ValueError("Review has no words")
+                results.append((self.scorer.map_id(field(r,"user","reviewerID"),"users"),self.scorer.map_id(field(r,"item","asin"),"items"),rev))
+            except Exception as e:
+                results.append(e)
+
+        ok = [i for i,res in enumerate(results) if not isinstance(res,Exception)]
+        if len(ok) > 0:
+            probs = self.scorer.predict(*zip(*[results[i] for i in ok]))
+            for i,p in zip(ok,probs):
+                results[i] = {"pred":self.scorer.labels[int(p.argmax())],"probs":p.tolist()}
+
+        return results
+
+    def metrics(self):
+        lat = np.array(self.latencies) * 1000
+        sizes = np.array(self.batch_sizes)
+
+        cache = self.scorer.net.bias_cache or {}
+        sents = self.scorer.net.sentence_cache
+
+        return {"requests":self.n_requests,"batches":self.n_batches,
+                "bias_cache":{"{}_{}".format(*k):c.stats() for k,c in cache.items()},
+                "sentence_cache":sents.stats() if sents is not None else None,
+                "latency_ms":{"p50":float(np.percentile(lat,50)) if len(lat) else None,"p99":float(np.percentile(lat,99)) if len(lat) else None},
+                "batch_size":{"mean":float(sizes.mean()) if len(sizes) else None,"p50":float(np.percentile(sizes,50)) if len(sizes) else None,"max":int(sizes.max()) if len(sizes) else None}}
+
+
+async def read_request(reader):
+    """
+    Minimal HTTP/1.1 request parsing: returns (method, path, headers, body) or None on closed connection
+    """
+    line = await reader.readline()
+    if not line:
+        return None
+
+    method,path,_ = line.decode("latin-1").split(" ",2)
+    headers = {}
+    while True:
+        h = await reader.readline()
+        if h in (b"\r\n",b"\n",b""):
+            break
+        k,v = h.decode("latin-1").split(":",1)
+        headers[k.strip().lower()] = v.strip()
+
+    body = await reader.readexactly(int(headers.get("content-length",0)))
+    return method,path,headers,body
+
+
+def response(status,obj,keep_alive):
+    body = json.dumps(obj).encode("utf-8")
+    head = "HTTP/1.1 {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\nConnection: {}\r\n\r\n".format(status,len(body),"keep-alive" if keep_alive else "close")
+    return head.encode("latin-1") + body
+
+
+def handler_builder(batcher):
+
+    async def handle(reader,writer):
+        try:
+            while True:
+                req = await read_request(reader)
+                if req is None:
+                    break
+
+                method,path,headers,body = req
+                keep_alive = headers.get("connection","keep-alive").lower() != "close"
+
+                if method == "POST" and path == "/predict":
+                    try:
+                        writer.write(response("200 OK",await batcher.predict(json.loads(body)),keep_alive))
+                    except (ValueError,KeyError) as e:
+                        writer.write(response("400 Bad Request",{"error":str(e)},keep_alive))
+                    except Exception as e:
+                        writer.write(response("500 Internal Server Error",{"error":repr(e)},keep_alive))
+                elif method == "POST" and path == "/reload":
+                    try:
+                        model = json.loads(body)["model"]
+                        await batcher.reload(model)
+                        writer.write(response("200 OK",{"model":model},keep_alive))
+                    except (ValueError,KeyError,OSError) as e:
+                        writer.write(response("400 Bad Request",{"error":str(e)},keep_alive))
+                    except Exception as e:
+                        writer.write(response("500 Internal Server Error",{"error":repr(e)},keep_alive))
+                elif method == "GET" and path == "/metrics":
+                    writer.write(response("200 OK",batcher.metrics(),keep_alive))
+                else:
+                    writer.write(response("404 Not Found",{"error":"unknown route"},keep_alive))
+
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError,asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    return handle
+
+
+def main(args):
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    scorer = Scorer(args.model,b_size=args.max_batch,bias_cache=args.bias_cache,sentence_cache=args.sentence_cache,precision=args.precision)
+    vectorizer = Vectorizer(scorer.word_dict,max_sent_len=args.max_sents,max_word_len=args.max_words,tokenizer=scorer.net.tokenizer)
+    vectorizer.vectorize_batch(["Warm up."]) # loads the tokenizer (spaCy model) now rather than on the first request
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    batcher = MicroBatcher(scorer,vectorizer,window=args.window/1000.,max_batch=args.max_batch)
+    server = loop.run_until_complete(asyncio.start_server(handler_builder(batcher),args.host,args.port))
+    loop.create_task(batcher.run())
+
+    print("Serving on http://{}:{} (batch window {}ms, max batch {})".format(args.host,args.port,args.window,args.max_batch))
+
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        print(json.dumps(batcher.metrics()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Online scoring server with request micro-batching')
+    parser.add_argument("model", type=str, help="model saved by main.py --save")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--window", type=float, default=5, help="batching window (ms)")
+    parser.add_argument("--max-batch", type=int, default=64)
+    parser.add_argument("--threads", type=int, help="torch cpu threads")
+    parser.add_argument("--bias-cache", type=int, default=100000, help="cache the user/item attention biases of at most N ids per table (0: off)")
+    parser.add_argument("--sentence-cache", type=float, default=0, help="reuse word-level GRU outputs of already seen sentences, at most N MB (0: off)")
+    parser.add_argument("--precision", choices=PRECISIONS, help="overrides the precision saved with the model (see quantize.py)")
+    parser.add_argument("--max-words", type=int,default=32)
+    parser.add_argument("--max-sents",type=int,default=16)
+    args = parser.parse_args()
+
+    main(args)